@@ -1,13 +1,14 @@
 import os
 import json
-import hashlib
-import mimetypes
-import requests
 from datetime import datetime, timezone
 
 from dotenv import load_dotenv
 from simple_salesforce import Salesforce
 from pymongo import MongoClient, ASCENDING
+from dmsHelpers import (
+    spool_version_data, upload_multipart, ParentCache, load_unchanged_ids,
+    HttpTransport, RetryPolicy, RetryExhausted, dedupe_policy, ensure_checksum_index, find_uploaded_blob, resolve_duplicate
+)
 
 # ---------------- LOAD ENV ----------------
 load_dotenv()
@@ -22,11 +23,20 @@ DMS_AUTH = os.getenv("DMS_AUTH_HEADER")
 
 MONGO_URI = os.getenv("MONGO_CONNECTION_STRING")
 
-DOWNLOAD_DIR = "large_files"
 MAX_SIZE = 6 * 1024 * 1024
-
-if not os.path.exists(DOWNLOAD_DIR):
-    os.makedirs(DOWNLOAD_DIR)
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DMS_DOWNLOAD_CHUNK_SIZE", 1024 * 1024))  # bytes per read while streaming
+SPOOL_MAX_MEMORY = int(os.getenv("DMS_SPOOL_MAX_MEMORY", 16 * 1024 * 1024))  # above this a file spills to a temp file
+PARENT_CACHE_SIZE = int(os.getenv("DMS_PARENT_CACHE_SIZE", 10000))  # parent records kept for Vertical/Agreement lookups
+PARENT_CACHE_TTL = int(os.getenv("DMS_PARENT_CACHE_TTL", 900))  # seconds before a cached parent is re-queried
+DMS_REGISTER_URL = os.getenv("DMS_REGISTER_ENDPOINT")
+DEDUPE_POLICY = dedupe_policy(os.getenv("DMS_DEDUPE_POLICY", "off"), DMS_REGISTER_URL)  # off / reference / register
+DMS_TIMEOUT_RETRIES = int(os.getenv("DMS_TIMEOUT_RETRIES", 2))  # connect/read timeouts
+DMS_ERROR_RETRIES = int(os.getenv("DMS_ERROR_RETRIES", 4))  # 429 and 5xx responses
+
+# ---------------- PARENT CACHE ----------------
+parent_cache = ParentCache(max_size=PARENT_CACHE_SIZE, ttl=PARENT_CACHE_TTL)
+transport = HttpTransport()  # one keep-alive session per host, reused for every file
+retry_policy = RetryPolicy(DMS_TIMEOUT_RETRIES, DMS_ERROR_RETRIES)
 
 # ---------------- OBJECT OPTIONS ----------------
 SOBJECT_OPTIONS = [
@@ -99,32 +109,15 @@ def mongo_connect():
     col = db["DMS_FILE_METADATA"]
 
     col.create_index([("ContentDocumentId__c", ASCENDING)], unique=True)
+    ensure_checksum_index(col)
 
     print("✅ MongoDB Connected")
     return col
 
-# ---------------- HASH ----------------
-def generate_sha1(file_path):
-    sha1 = hashlib.sha1()
-    with open(file_path, "rb") as f:
-        while chunk := f.read(8192):
-            sha1.update(chunk)
-    return sha1.hexdigest()
-
 # ---------------- DOWNLOAD ----------------
-def download_file(sf, version_id, filename):
-    url = f"{sf.base_url}sobjects/ContentVersion/{version_id}/VersionData"
-    headers = {"Authorization": f"Bearer {sf.session_id}"}
-
-    path = os.path.join(DOWNLOAD_DIR, filename)
-
-    with requests.get(url, headers=headers, stream=True) as r:
-        r.raise_for_status()
-        with open(path, "wb") as f:
-            for chunk in r.iter_content(8192):
-                f.write(chunk)
-
-    return path
+def download_file(sf, version_id):
+    """Spool and hash VersionData in one pass; returns (spool, size, sha1)."""
+    return spool_version_data(sf, version_id, SPOOL_MAX_MEMORY, DOWNLOAD_CHUNK_SIZE, session=transport)
 
 # ---------------- DMS WRAPPER ----------------
 class DMSRequestWrapper:
@@ -164,28 +157,24 @@ class DMSRequestWrapper:
         }
 
 # ---------------- DMS UPLOAD ----------------
-def upload_to_dms(file_path, metadata):
-
-    files = {
-        "data": (None, json.dumps(metadata), "application/json"),
-        "image": (
-            os.path.basename(file_path),
-            open(file_path, "rb"),
-            mimetypes.guess_type(file_path)[0] or "application/octet-stream"
-        )
-    }
+def upload_to_dms(spool, size, filename, metadata):
 
     headers = {"Authorization": DMS_AUTH}
 
     print("⬆️ Uploading to DMS...")
     print("📡 Payload:", json.dumps(metadata, indent=2))
 
-    res = requests.post(DMS_URL, headers=headers, files=files, timeout=600)
+    # The spooled bytes become the multipart body as-is and are rewound for every retry
+    with spool:
+        res, attempts, retry_seconds = retry_policy.call(
+            lambda: upload_multipart(DMS_URL, headers, metadata, filename, spool, size, timeout=600, session=transport),
+            rewind=spool
+        )
 
     print("📡 Status:", res.status_code)
     print("📡 Response:", res.text)
 
-    return res
+    return res, attempts, retry_seconds
 
 # ---------------- MAIN ----------------
 def main():
@@ -208,6 +197,7 @@ def main():
            ContentDocument.FileType,
            ContentDocument.LatestPublishedVersion.Id,
            ContentDocument.LatestPublishedVersion.ContentSize,
+           ContentDocument.LatestPublishedVersion.Checksum,
            ContentDocument.LatestPublishedVersion.FileExtension,
            ContentDocument.LatestPublishedVersion.CreatedDate,
            ContentDocument.LatestPublishedVersion.CreatedBy.Name
@@ -231,16 +221,26 @@ def main():
 
     print("📦 Files >6MB:", len(large_files))
 
+    # SuccessToDMS files whose version, Checksum and size still match are skipped without a download
+    done = load_unchanged_ids(mongo, {
+        r["ContentDocumentId"]: (
+            r["ContentDocument"]["LatestPublishedVersion"]["Id"],
+            r["ContentDocument"]["LatestPublishedVersion"].get("Checksum"),
+            r["ContentDocument"]["LatestPublishedVersion"]["ContentSize"]
+        )
+        for r in large_files
+    }, done_filter={"Migrate_Status__c": "SuccessToDMS"})
+    large_files = [r for r in large_files if r["ContentDocumentId"] not in done]
+
+    if sObjectType not in VF_OBJECTS:
+        parent_cache.prefetch(sf, {sObjectType: {r["LinkedEntityId"] for r in large_files}})
+
     # ---------------- PROCESS ----------------
     for rec in large_files:
 
         try:
             doc_id = rec["ContentDocumentId"]
 
-            if mongo.find_one({"ContentDocumentId__c": doc_id}):
-                print("⏭️ Already processed:", doc_id)
-                continue
-
             version = rec["ContentDocument"]["LatestPublishedVersion"]
             version_id = version["Id"]
 
@@ -248,12 +248,21 @@ def main():
             if version.get("FileExtension"):
                 filename += "." + version["FileExtension"]
 
-            print("\n⬇️ Download:", filename)
+            # -------- DEDUPE --------
+            # Same bytes already in DMS: Salesforce's Checksum matches before download, our SHA-1 after
+            original = None
+            if DEDUPE_POLICY != "off":
+                original = find_uploaded_blob(mongo, version["ContentSize"], sf_checksum=version.get("Checksum"))
 
-            path = download_file(sf, version_id, filename)
+            if original:
+                spool, size, checksum = None, version["ContentSize"], original["Checksum__c"]
+            else:
+                print("\n⬇️ Download:", filename)
 
-            size = os.path.getsize(path)
-            checksum = generate_sha1(path)
+                spool, size, checksum = download_file(sf, version_id)
+
+                if DEDUPE_POLICY != "off":
+                    original = find_uploaded_blob(mongo, size, checksum=checksum)
 
             linked_id = rec["LinkedEntityId"]
 
@@ -261,31 +270,16 @@ def main():
             if sObjectType in VF_OBJECTS:
                 vertical = "VF"
                 agreement_no = "UNKNOWN"
+                cache_hit = None
                 print("📊 Vertical: VF (Hardcoded)")
 
             else:
-                vertical = None
-                agreement_no = "UNKNOWN"
-
-                try:
-                    obj_query = f"""
-                    SELECT Vertical__c, Agreement_No__c
-                    FROM {sObjectType}
-                    WHERE Id = '{linked_id}'
-                    LIMIT 1
-                    """
-
-                    res = sf.query(obj_query)
-
-                    if res["records"]:
-                        data = res["records"][0]
-                        vertical = data.get("Vertical__c")
-                        agreement_no = data.get("Agreement_No__c") or "UNKNOWN"
+                parent, cache_hit = parent_cache.lookup(sf, sObjectType, linked_id)
+                vertical = parent.get("Vertical__c")
+                agreement_no = parent.get("Agreement_No__c") or "UNKNOWN"
 
-                        print(f"📊 Vertical Fetched: {vertical}")
-
-                except Exception as e:
-                    print("⚠️ Parent fetch failed:", str(e))
+                if parent:
+                    print(f"📊 Vertical Fetched: {vertical}")
 
             # fallback
             if not vertical:
@@ -296,9 +290,27 @@ def main():
                 rec, size, checksum, vertical, agreement_no, filename
             )
 
-            res = upload_to_dms(path, metadata)
+            dedupe = {}
+            if original:
+                if spool:
+                    spool.close()
 
-            status = "SuccessToDMS" if res.status_code in [200, 201] else "FailedToDMS"
+                attempts, retry_seconds = 0, 0
+                status, response_text, dedupe = resolve_duplicate(
+                    original, DEDUPE_POLICY, DMS_REGISTER_URL, {"Authorization": DMS_AUTH}, metadata, session=transport
+                )
+                print(f"♻️ Duplicate of {dedupe['Duplicate_Of__c']} ({DEDUPE_POLICY})")
+            else:
+                try:
+                    res, attempts, retry_seconds = upload_to_dms(spool, size, filename, metadata)
+
+                    status = "SuccessToDMS" if res.status_code in [200, 201] else "FailedToDMS"
+                    response_text = res.text
+                except RetryExhausted as e:
+                    # Still tracked, so an exhausted file is retried like any other failure
+                    print("⚠️ Retries exhausted:", str(e))
+                    status, response_text = "FailedToDMS", str(e)
+                    attempts, retry_seconds = e.attempts, e.retry_seconds
 
             # -------- MONGO --------
             mongo.update_one(
@@ -306,29 +318,33 @@ def main():
                 {"$set": {
                     "ContentDocumentId__c": doc_id,
                     "Document_Name__c": filename,
+                    "ContentVersionId__c": version_id,
                     "Vertical__c": vertical,
                     "sObject_Name__c": sObjectType,
                     "sObject_Record_Id__c": linked_id,
-                    "DMS_Response__c": res.text,
+                    "Parent_Cache_Hit__c": cache_hit,
+                    "DMS_Response__c": response_text,
+                    "Upload_Attempts__c": attempts,
+                    "Retry_Latency_Sec__c": retry_seconds,
                     "Migrate_Status__c": status,
                     "Checksum__c": checksum,
+                    "SF_Checksum__c": version.get("Checksum"),
                     "File_Size": size,
-                    "CreatedDate": datetime.now(timezone.utc)
+                    "CreatedDate": datetime.now(timezone.utc),
+                    **dedupe
                 }},
                 upsert=True
             )
 
             print("💾 Mongo Saved")
 
-            if status == "SuccessToDMS":
-                os.remove(path)
-                print("🧹 Local file deleted")
-
             print("✅ Completed:", filename)
 
         except Exception as e:
             print("❌ ERROR:", str(e))
 
+    print("📚 Parent cache:", parent_cache.stats())
+    print("🌐 HTTP pools:", transport.stats())
     print("\n🎉 ALL FILES PROCESSED")
 
 # ---------------- RUN ----------------
@@ -3,7 +3,6 @@ import csv
 import json
 import hashlib
 import mimetypes
-import requests
 import threading
  
 from datetime import datetime, timezone
@@ -11,7 +10,9 @@ from concurrent.futures import ThreadPoolExecutor, as_completed
  
 from dotenv import load_dotenv
 from simple_salesforce import Salesforce
+from requests.exceptions import HTTPError
 from pymongo import MongoClient, ASCENDING
+from dmsHelpers import download_version_data, load_done_ids, HttpTransport, AdaptiveLimiter, RetryPolicy, RetryExhausted
  
 # ---------------- CONFIG ----------------
 MAX_WORKERS = 5   # 🔥 Tune carefully (5 → 10 → 15)
@@ -30,11 +31,31 @@ DMS_AUTH = os.getenv("DMS_AUTH_HEADER")
 MONGO_URI = os.getenv("MONGO_CONNECTION_STRING")
  
 DOWNLOAD_DIR = "retry_files"
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DMS_DOWNLOAD_CHUNK_SIZE", 1024 * 1024))  # bytes per read while streaming
 os.makedirs(DOWNLOAD_DIR, exist_ok=True)
  
+# Downloads and uploads each adapt (AIMD) between MAX_WORKERS and their own ceiling
+SF_DOWNLOAD_MAX_WORKERS = int(os.getenv("SF_DOWNLOAD_MAX_WORKERS", MAX_WORKERS * 2))
+DMS_UPLOAD_MAX_WORKERS = int(os.getenv("DMS_UPLOAD_MAX_WORKERS", MAX_WORKERS * 4))
+SF_TARGET_P95 = float(os.getenv("SF_TARGET_P95_SECONDS", 30))
+DMS_TARGET_P95 = float(os.getenv("DMS_TARGET_P95_SECONDS", 60))
+MAX_ERROR_RATE = float(os.getenv("DMS_MAX_ERROR_RATE", 0.05))  # share of 429/5xx/no response per window
+DMS_TIMEOUT_RETRIES = int(os.getenv("DMS_TIMEOUT_RETRIES", 2))  # connect/read timeouts
+DMS_ERROR_RETRIES = int(os.getenv("DMS_ERROR_RETRIES", 4))  # 429 and 5xx responses
+ROW_WORKERS = max(SF_DOWNLOAD_MAX_WORKERS, DMS_UPLOAD_MAX_WORKERS)
+ 
 # ---------------- GLOBALS ----------------
 lock = threading.Lock()
-session = requests.Session()
+transport = HttpTransport(ROW_WORKERS)  # keep-alive pool per host, one connection per worker
+download_limiter = AdaptiveLimiter(
+    "SF download", MAX_WORKERS, maximum=SF_DOWNLOAD_MAX_WORKERS,
+    target_p95=SF_TARGET_P95, max_error_rate=MAX_ERROR_RATE
+)
+upload_limiter = AdaptiveLimiter(
+    "DMS upload", MAX_WORKERS, maximum=DMS_UPLOAD_MAX_WORKERS,
+    target_p95=DMS_TARGET_P95, max_error_rate=MAX_ERROR_RATE
+)
+retry_policy = RetryPolicy(DMS_TIMEOUT_RETRIES, DMS_ERROR_RETRIES)
  
 # ---------------- SALESFORCE ----------------
 def sf_login():
@@ -62,24 +83,24 @@ def mongo_connect():
 def generate_sha1(file_path):
     sha1 = hashlib.sha1()
     with open(file_path, "rb") as f:
-        while chunk := f.read(8192):
+        while chunk := f.read(DOWNLOAD_CHUNK_SIZE):
             sha1.update(chunk)
     return sha1.hexdigest()
  
 # ---------------- DOWNLOAD ----------------
-def download_file(sf, version_id, filename):
-    url = f"{sf.base_url}sobjects/ContentVersion/{version_id}/VersionData"
-    headers = {"Authorization": f"Bearer {sf.session_id}"}
- 
-    path = os.path.join(DOWNLOAD_DIR, filename)
- 
-    with requests.get(url, headers=headers, stream=True) as r:
-        r.raise_for_status()
-        with open(path, "wb") as f:
-            for chunk in r.iter_content(8192):
-                f.write(chunk)
- 
-    return path
+def download_file(sf, version_id, path):
+    """Download and hash in one pass; returns (path, size, sha1)."""
+    started = download_limiter.acquire()
+    status_code = None
+    try:
+        result = download_version_data(sf, version_id, path, DOWNLOAD_CHUNK_SIZE, session=transport)
+        status_code = 200
+        return result
+    except Exception as e:
+        status_code = getattr(getattr(e, "response", None), "status_code", None)
+        raise
+    finally:
+        download_limiter.release(started, status_code)
  
 # ---------------- DMS PAYLOAD ----------------
 def build_dms_payload(cv, doc_id, size, checksum, vertical, filename):
@@ -127,14 +148,6 @@ def process_row(sf, mongo, row):
  
         print(f"➡️ Processing {doc_id}")
  
-        # -------- DUPLICATE CHECK --------
-        existing = mongo.find_one({"ContentDocumentId__c": doc_id})
- 
-        if existing:
-            status = existing.get("Migrate_Status__c")
-            if status == "SuccessToDMS":
-                return f"⏭️ Skipped (Already Success) {doc_id}"
- 
         # -------- FETCH FILE --------
         cv_res = sf.query(f"""
             SELECT Id, Title, FileExtension, ContentSize,
@@ -150,40 +163,37 @@ def process_row(sf, mongo, row):
  
         cv = cv_res["records"][0]
  
-        # 🔥 UNIQUE FILENAME (CRITICAL FIX)
-        # filename = f"{doc_id}_{cv['Title']}"
         filename=cv['Title']
         if cv.get("FileExtension"):
             filename += "." + cv["FileExtension"]
  
-        path = os.path.join(DOWNLOAD_DIR, filename)
+        # 🔥 UNIQUE FILENAME (CRITICAL FIX)
+        # Same-title files from parallel rows must never share a local file
+        path = os.path.join(DOWNLOAD_DIR, f"{doc_id}_{filename}")
  
         # -------- DOWNLOAD (Retry Safe) --------
-        if not os.path.exists(path):
+        # download_file only renames a fully written file onto path
+        if os.path.exists(path) and os.path.getsize(path) == cv["ContentSize"]:
+            size = os.path.getsize(path)
+            checksum = generate_sha1(path)
+        else:
             try:
-                path = download_file(sf, cv["Id"], filename)
+                path, size, checksum = download_file(sf, cv["Id"], path)
             except Exception as e:
                 return f"❌ Download Failed {doc_id}: {str(e)}"
  
-        # -------- FILE CHECK --------
-        if not os.path.exists(path):
-            return f"❌ File Missing After Download {doc_id}"
- 
-        size = os.path.getsize(path)
-        checksum = generate_sha1(path)
- 
         payload = build_dms_payload(cv, doc_id, size, checksum, vertical, filename)
  
-        # -------- RETRY (3 TIMES) --------
-        res = None
-        status = "FailedToDMS"
+        def send():
+            nonlocal path, size, checksum
  
-        for attempt in range(3):
-            try:
-                # 🔥 Re-check file before every attempt
-                if not os.path.exists(path):
-                    path = download_file(sf, cv["Id"], filename)
+            # 🔥 Re-check file before every attempt
+            if not os.path.exists(path):
+                path, size, checksum = download_file(sf, cv["Id"], path)
  
+            started = upload_limiter.acquire()
+            res = None
+            try:
                 with open(path, "rb") as f:
                     files = {
                         "data": (None, json.dumps(payload), "application/json"),
@@ -194,24 +204,30 @@ def process_row(sf, mongo, row):
                         )
                     }
  
-                    res = session.post(
+                    res = transport.post(
                         DMS_URL,
                         headers={"Authorization": DMS_AUTH},
                         files=files,
                         timeout=300
                     )
- 
-                if res.status_code in [200, 201]:
-                    status = "SuccessToDMS"
-                    break
-                else:
-                    print(f"⚠️ Attempt {attempt+1} failed for {doc_id}: {res.status_code}")
- 
-            except Exception as e:
-                print(f"⚠️ Attempt {attempt+1} error for {doc_id}: {str(e)}")
- 
-                if attempt == 2:
-                    return f"❌ ERROR {doc_id}: {str(e)}"
+                return res
+            finally:
+                upload_limiter.release(started, res.status_code if res is not None else None)
+ 
+        # -------- RETRY (timeouts and 429/5xx only, with backoff) --------
+        try:
+            res, attempts, retry_seconds = retry_policy.call(send)
+            response_text = res.text
+            status = "SuccessToDMS" if res.status_code in [200, 201] else "FailedToDMS"
+        except RetryExhausted as e:
+            print(f"⚠️ Retries exhausted for {doc_id}: {str(e)}")
+            response_text, status = str(e), "FailedToDMS"
+            attempts, retry_seconds = e.attempts, e.retry_seconds
+        except HTTPError as e:
+            # The re-download in send() was refused; track it like any other failed upload
+            print(f"⚠️ Re-download failed for {doc_id}: {str(e)}")
+            response_text, status = f"Download Failed: {str(e)}", "FailedToDMS"
+            attempts, retry_seconds = 0, 0
  
         # -------- MONGO UPDATE --------
         with lock:
@@ -223,7 +239,9 @@ def process_row(sf, mongo, row):
                     "Vertical__c": "HL", #Need to change Vertical accordingly
                     "sObject_Name__c": "OContactRecording__c", #Need to change objectName accordingly
                     "sObject_Record_Id__c": parent_id,
-                    "DMS_Response__c": res.text if res else "ERROR",
+                    "DMS_Response__c": response_text,
+                    "Upload_Attempts__c": attempts,
+                    "Retry_Latency_Sec__c": retry_seconds,
                     "Migrate_Status__c": status,
                     "Checksum__c": checksum,
                     "File_Size": size,
@@ -262,14 +280,28 @@ def main():
         reader = csv.DictReader(file)
         rows = list(reader)
  
-    print(f"🚀 Processing {len(rows)} records with {MAX_WORKERS} threads")
+    # -------- DUPLICATE CHECK --------
+    # Files already SuccessToDMS are dropped before scheduling, in one pass over Mongo
+    done = load_done_ids(
+        mongo,
+        (row.get("ContentDocumentId") for row in rows),
+        done_filter={"Migrate_Status__c": "SuccessToDMS"}
+    )
+    rows = [row for row in rows if row.get("ContentDocumentId") not in done]
+ 
+    print(
+        f"🚀 Processing {len(rows)} records → downloads {MAX_WORKERS}-{SF_DOWNLOAD_MAX_WORKERS}, "
+        f"uploads {MAX_WORKERS}-{DMS_UPLOAD_MAX_WORKERS} at once"
+    )
  
-    with ThreadPoolExecutor(max_workers=MAX_WORKERS) as executor:
+    with ThreadPoolExecutor(max_workers=ROW_WORKERS) as executor:
         futures = [executor.submit(process_row, sf, mongo, row) for row in rows]
  
         for future in as_completed(futures):
             print(future.result())
  
+    print("🌐 HTTP pools:", transport.stats())
+    print(f"🎚️ Final limits → download {download_limiter.limit} / upload {upload_limiter.limit}")
     print("\n🎉 BULK PROCESS COMPLETED")
  
 # ---------------- RUN ----------------
@@ -0,0 +1,943 @@
+import io
+import os
+import time
+import json
+import uuid
+import base64
+import random
+import hashlib
+import tempfile
+import mimetypes
+import threading
+import socket
+import requests
+from urllib.parse import urlsplit
+from email.utils import parsedate_to_datetime
+from datetime import datetime, timedelta, timezone
+from collections import OrderedDict
+from pymongo import ReturnDocument, UpdateOne
+from requests.adapters import HTTPAdapter
+from concurrent.futures import ThreadPoolExecutor
+
+
+# ---------------- HTTP TRANSPORT ----------------
+class HttpTransport:
+    """Keep-alive sessions, one per host, shared by every worker thread.
+
+    Each host gets a requests.Session whose connection pool holds pool_size
+    connections and blocks when they are all busy, so TLS handshakes are
+    paid once per connection instead of once per file. get/post match the
+    requests module, so an instance can be passed wherever session= is.
+    """
+
+    def __init__(self, pool_size=10):
+        self.pool_size = pool_size
+        self._sessions = {}
+        self._lock = threading.Lock()
+
+    def session(self, url):
+        host = urlsplit(url).netloc
+        with self._lock:
+            if host not in self._sessions:
+                adapter = HTTPAdapter(pool_connections=1, pool_maxsize=self.pool_size, pool_block=True)
+                session = requests.Session()
+                session.mount("https://", adapter)
+                session.mount("http://", adapter)
+                self._sessions[host] = (session, adapter)
+            return self._sessions[host][0]
+
+    def get(self, url, **kwargs):
+        return self.session(url).get(url, **kwargs)
+
+    def post(self, url, **kwargs):
+        return self.session(url).post(url, **kwargs)
+
+    def stats(self):
+        """Per host: connections opened (one TLS handshake each), requests sent and connections in use."""
+        with self._lock:
+            adapters = {host: adapter for host, (_, adapter) in self._sessions.items()}
+
+        stats = {}
+        for host, adapter in adapters.items():
+            pools = adapter.poolmanager.pools
+            host_pools = [pool for pool in (pools.get(key) for key in pools.keys()) if pool]
+            stats[host] = {
+                "connections": sum(pool.num_connections for pool in host_pools),
+                "requests": sum(pool.num_requests for pool in host_pools),
+                "in_use": sum(self.pool_size - pool.pool.qsize() for pool in host_pools if pool.pool),
+                "pool_size": self.pool_size
+            }
+        return stats
+
+    def close(self):
+        with self._lock:
+            for session, _ in self._sessions.values():
+                session.close()
+            self._sessions.clear()
+
+
+# ---------------- STREAMING DOWNLOAD ----------------
+def _stream_version_data(sf, version_id, out, chunk_size, timeout=None, session=requests):
+    url = f"{sf.base_url}sobjects/ContentVersion/{version_id}/VersionData"
+    headers = {"Authorization": f"Bearer {sf.session_id}"}
+
+    sha1 = hashlib.sha1()
+    size = 0
+
+    with session.get(url, headers=headers, stream=True, timeout=timeout) as r:
+        r.raise_for_status()
+        for chunk in r.iter_content(chunk_size):
+            sha1.update(chunk)
+            size += len(chunk)
+            out.write(chunk)
+
+    return size, sha1.hexdigest()
+
+
+def download_version_data(sf, version_id, path, chunk_size=1024 * 1024, session=requests):
+    """Stream a ContentVersion's VersionData to path, hashing it on the way.
+
+    Returns (path, size, sha1) from the single pass over the response. The
+    bytes go to a unique temp file next to path that is renamed onto path only
+    once complete, so path never holds a partial file, even while another
+    thread downloads the same document.
+    """
+    fd, part = tempfile.mkstemp(dir=os.path.dirname(path) or ".", suffix=".part")
+    try:
+        with os.fdopen(fd, "wb") as f:
+            size, checksum = _stream_version_data(sf, version_id, f, chunk_size, session=session)
+        os.replace(part, path)
+    except Exception:
+        if os.path.exists(part):
+            os.remove(part)
+        raise
+
+    return path, size, checksum
+
+
+def spool_version_data(sf, version_id, max_memory=16 * 1024 * 1024, chunk_size=1024 * 1024, timeout=None, session=requests):
+    """Stream VersionData into a spooled temp buffer, hashing it on the way.
+
+    The buffer stays in RAM up to max_memory and spills to a temp file above
+    it, which is deleted on close. Returns (spool, size, sha1), rewound and
+    ready to be relayed; the caller closes the spool.
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=max_memory)
+    try:
+        size, checksum = _stream_version_data(sf, version_id, spool, chunk_size, timeout, session)
+    except Exception:
+        spool.close()
+        raise
+
+    spool.seek(0)
+    return spool, size, checksum
+
+
+# ---------------- STREAMED UPLOAD BODIES ----------------
+class StreamedBody:
+    """File-like request body stitched together from several readers.
+
+    Parts are read only as requests sends the body, and the total length is
+    known up front so a Content-Length is sent instead of chunked encoding.
+    """
+
+    def __init__(self, parts, length, content_type):
+        self.content_type = content_type
+        self._parts = list(parts)
+        self._length = length
+
+    def __len__(self):
+        return self._length
+
+    def read(self, n=-1):
+        out = b""
+        while self._parts and (n is None or n < 0 or len(out) < n):
+            chunk = self._parts[0].read(-1 if n is None or n < 0 else n - len(out))
+            if not chunk:
+                self._parts.pop(0)
+                continue
+            out += chunk
+        return out
+
+
+class _Base64Reader:
+    """Encodes fileobj to base64 as it is read, holding only a few bytes between reads.
+
+    A read(n) encodes just enough source bytes (a multiple of 3) to return n,
+    so small reads over a multi-GB spool cost O(n) each instead of re-slicing a
+    large buffer. fileobj must return full reads until EOF (files and spools
+    do), so only the final read needs padding.
+    """
+
+    def __init__(self, fileobj, chunk_size=768 * 1024):
+        self._fileobj = fileobj
+        self._chunk_size = max(chunk_size - chunk_size % 3, 3)
+        self._buffer = b""
+        self._pos = 0
+
+    def read(self, n=-1):
+        if n is None or n < 0:
+            parts = [self._buffer[self._pos:]]
+            while raw := self._fileobj.read(self._chunk_size):
+                parts.append(base64.b64encode(raw))
+            self._buffer, self._pos = b"", 0
+            return b"".join(parts)
+
+        available = len(self._buffer) - self._pos
+        if available < n:
+            raw = self._fileobj.read(-(-(n - available) // 4) * 3)
+            self._buffer = self._buffer[self._pos:] + base64.b64encode(raw)
+            self._pos = 0
+
+        out = self._buffer[self._pos:self._pos + n]
+        self._pos += len(out)
+        return out
+
+
+def _quote_filename(filename):
+    return filename.replace("\r", "%0D").replace("\n", "%0A").replace('"', "%22")
+
+
+class MultipartBody(StreamedBody):
+    """multipart/form-data body with the DMS "data" JSON part and an "image" file part."""
+
+    def __init__(self, metadata, filename, fileobj, size, mime=None):
+        boundary = uuid.uuid4().hex
+        mime = mime or mimetypes.guess_type(filename)[0] or "application/octet-stream"
+
+        head = (
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="data"\r\n'
+            f"Content-Type: application/json\r\n\r\n"
+            f"{json.dumps(metadata)}\r\n"
+            f"--{boundary}\r\n"
+            f'Content-Disposition: form-data; name="image"; filename="{_quote_filename(filename)}"\r\n'
+            f"Content-Type: {mime}\r\n\r\n"
+        ).encode("utf-8")
+        tail = f"\r\n--{boundary}--\r\n".encode("utf-8")
+
+        super().__init__(
+            [io.BytesIO(head), fileobj, io.BytesIO(tail)],
+            len(head) + size + len(tail),
+            f"multipart/form-data; boundary={boundary}"
+        )
+
+
+class Base64JsonBody(StreamedBody):
+    """JSON object of fields plus file_field holding fileobj as base64, encoded while it is sent."""
+
+    def __init__(self, fields, file_field, fileobj, size):
+        head = json.dumps(fields)[:-1] + (", " if fields else "") + json.dumps(file_field) + ': "'
+        head = head.encode("utf-8")
+        tail = b'"}'
+
+        super().__init__(
+            [io.BytesIO(head), _Base64Reader(fileobj), io.BytesIO(tail)],
+            len(head) + 4 * ((size + 2) // 3) + len(tail),
+            "application/json"
+        )
+
+
+def upload_multipart(url, headers, metadata, filename, fileobj, size, timeout=600, session=requests):
+    """POST fileobj to DMS as data+image multipart without loading it into memory."""
+    body = MultipartBody(metadata, filename, fileobj, size)
+    return session.post(
+        url,
+        headers={**headers, "Content-Type": body.content_type},
+        data=body,
+        timeout=timeout
+    )
+
+
+def upload_base64_json(url, headers, fields, file_field, fileobj, size, timeout=600, session=requests):
+    """POST fileobj inside a JSON body as base64, encoding it chunk by chunk on the way out."""
+    body = Base64JsonBody(fields, file_field, fileobj, size)
+    return session.post(
+        url,
+        headers={**headers, "Content-Type": body.content_type},
+        data=body,
+        timeout=timeout
+    )
+
+
+# ---------------- SET-BASED LOOKUPS ----------------
+def chunk_ids_for_soql(ids, max_chars=10000):
+    """Split ids into chunks whose quoted IN (...) list stays under max_chars.
+
+    REST queries travel in the URL, so the budget sits well below both the
+    SOQL length limit and the request URI limit.
+    """
+    chunk, length = [], 0
+    for record_id in ids:
+        cost = len(record_id) + 3  # quotes and comma
+        if chunk and length + cost > max_chars:
+            yield chunk
+            chunk, length = [], 0
+        chunk.append(record_id)
+        length += cost
+
+    if chunk:
+        yield chunk
+
+
+def soql_id_list(ids):
+    return ",".join(f"'{record_id}'" for record_id in ids)
+
+
+def resolve_linked_documents(sf, doc_ids, parent_query, max_chars=10000):
+    """Map ContentDocumentId → LinkedEntityId for documents linked to a parent in parent_query.
+
+    parent_query is a semi-join such as "SELECT Id FROM OReceipt__c WHERE
+    Vertical__c = 'HL'", so one ContentDocumentLink query per chunk replaces
+    a link query per file plus a parent query per link.
+    """
+    linked = {}
+    for chunk in chunk_ids_for_soql(list(doc_ids), max_chars):
+        query = f"""
+            SELECT ContentDocumentId, LinkedEntityId
+            FROM ContentDocumentLink
+            WHERE ContentDocumentId IN ({soql_id_list(chunk)})
+            AND LinkedEntityId IN ({parent_query})
+        """
+        for rec in sf.query_all(query)["records"]:
+            linked.setdefault(rec["ContentDocumentId"], rec["LinkedEntityId"])
+
+    return linked
+
+
+def fetch_document_links(sf, doc_ids, max_chars=10000):
+    """Map ContentDocumentId → (LinkedEntityId, LinkedEntity.Type) with chunked IN queries."""
+    links = {}
+    for chunk in chunk_ids_for_soql(list(doc_ids), max_chars):
+        query = f"""
+            SELECT ContentDocumentId, LinkedEntityId, LinkedEntity.Type
+            FROM ContentDocumentLink
+            WHERE ContentDocumentId IN ({soql_id_list(chunk)})
+        """
+        for rec in sf.query_all(query)["records"]:
+            links.setdefault(
+                rec["ContentDocumentId"],
+                (rec["LinkedEntityId"], (rec.get("LinkedEntity") or {}).get("Type"))
+            )
+
+    return links
+
+
+def _is_invalid_field(error):
+    return "INVALID_FIELD" in str(error)
+
+
+def _has_field(sf, sobject, field):
+    try:
+        sf.query(f"SELECT {field} FROM {sobject} LIMIT 1")
+        return True
+    except Exception as e:
+        if _is_invalid_field(e):
+            return False
+        raise
+
+
+def _query_parent_chunks(sf, sobject, record_ids, fields, max_chars=10000):
+    """Yield (chunk ids, rows) per IN query; rows is None when the query failed.
+
+    Only an INVALID_FIELD error narrows the query to the fields the type has;
+    timeouts, limits and any other error fail just that chunk, so callers
+    never mistake a failed query for parents without the fields.
+    """
+    wanted = list(fields)
+    for chunk in chunk_ids_for_soql([rid for rid in record_ids if rid], max_chars):
+        rows = []
+        while wanted:
+            try:
+                rows = sf.query_all(
+                    f"SELECT Id, {', '.join(wanted)} FROM {sobject} WHERE Id IN ({soql_id_list(chunk)})"
+                )["records"]
+                break
+            except Exception as e:
+                try:
+                    usable = [field for field in wanted if _has_field(sf, sobject, field)] if _is_invalid_field(e) else wanted
+                except Exception:
+                    usable = wanted
+                if usable == wanted:
+                    print(f"⚠️ {sobject} parent fetch failed for {len(chunk)} ids: {e}")
+                    rows = None
+                    break
+                print(f"⚠️ {sobject} parent fetch narrowed to {usable}: {e}")
+                wanted = usable
+
+        yield chunk, rows
+
+
+def fetch_parent_fields(sf, parent_ids_by_type, fields=("Vertical__c", "Agreement_No__c"), max_chars=10000, failed=None):
+    """Map (sObject type, record Id) → parent record holding fields, one IN query per chunk and type.
+
+    A type missing one of the fields (no Agreement_No__c, say) is retried with
+    just the fields it has, so one absent field no longer hides the others.
+    Ids of chunks whose query failed are left out and added to failed, if given.
+    """
+    parents = {}
+
+    for sobject, record_ids in parent_ids_by_type.items():
+        if not sobject:
+            continue
+
+        for chunk, rows in _query_parent_chunks(sf, sobject, record_ids, fields, max_chars):
+            if rows is None:
+                if failed is not None:
+                    failed.update((sobject, rid) for rid in chunk)
+                continue
+            for row in rows:
+                parents[(sobject, row["Id"])] = row
+
+    print(f"📚 Parent metadata prefetched → {len(parents)} records")
+    return parents
+
+
+def key_prefix_map(sf):
+    """Map the 3-character Id key prefix → sObject name from one global describe."""
+    return {
+        obj["keyPrefix"]: obj["name"]
+        for obj in sf.describe()["sobjects"]
+        if obj.get("keyPrefix")
+    }
+
+
+class ParentCache:
+    """Bounded LRU cache of parent records keyed by (sObject type, record Id).
+
+    Entries expire after ttl seconds so a long run picks up edited parents,
+    and the least recently used entry is dropped once max_size is reached.
+    Parents that do not exist are cached as {} too, but a failed query is
+    never cached, so the next lookup asks Salesforce again. Safe to share
+    between threads; two threads missing the same key at once may both query it.
+    """
+
+    def __init__(self, fields=("Vertical__c", "Agreement_No__c"), max_size=10000, ttl=900):
+        self.fields = tuple(fields)
+        self.max_size = max_size
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def _get(self, key):
+        entry = self._entries.get(key)
+        if entry is None:
+            return None
+        if entry[0] < time.monotonic():
+            del self._entries[key]
+            return None
+        self._entries.move_to_end(key)
+        return entry[1]
+
+    def _put(self, key, row):
+        self._entries[key] = (time.monotonic() + self.ttl, row)
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+
+    def prefetch(self, sf, parent_ids_by_type, max_chars=10000):
+        """Load every parent not already cached with chunked IN queries; counts as neither hit nor miss."""
+        with self._lock:
+            missing = {
+                sobject: {rid for rid in record_ids if rid and self._get((sobject, rid)) is None}
+                for sobject, record_ids in parent_ids_by_type.items() if sobject
+            }
+
+        failed = set()
+        found = fetch_parent_fields(sf, missing, self.fields, max_chars, failed)
+
+        with self._lock:
+            for sobject, record_ids in missing.items():
+                for rid in record_ids:
+                    if (sobject, rid) not in failed:
+                        self._put((sobject, rid), found.get((sobject, rid), {}))
+
+    def lookup(self, sf, sobject, record_id):
+        """Return (parent row, cache hit) for one parent, querying Salesforce on a miss.
+
+        When that query fails the row is {} so callers fall back to their
+        defaults ("UNKNOWN" vertical), and nothing is cached: the next lookup
+        of this parent asks Salesforce again.
+        """
+        if not sobject or not record_id:
+            return {}, False
+
+        key = (sobject, record_id)
+        with self._lock:
+            row = self._get(key)
+            if row is not None:
+                self.hits += 1
+                return row, True
+            self.misses += 1
+
+        _, rows = next(_query_parent_chunks(sf, sobject, [record_id], self.fields))
+        if rows is None:
+            return {}, False
+        row = rows[0] if rows else {}
+
+        with self._lock:
+            self._put(key, row)
+        return row, False
+
+    def stats(self):
+        with self._lock:
+            lookups = self.hits + self.misses
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "hit_rate": round(self.hits / lookups, 3) if lookups else 0.0,
+                "size": len(self._entries)
+            }
+
+
+# ---------------- IDEMPOTENCY ----------------
+def load_done_ids(coll, ids, id_field="ContentDocumentId__c", done_filter=None, chunk_size=10000):
+    """Return the subset of ids already tracked in coll (and matching done_filter).
+
+    Only id_field is projected and ids go in $in chunks, so a resumed run
+    learns what to skip in a few round trips instead of a find_one per file.
+    """
+    ids = list({record_id for record_id in ids if record_id})
+    done = set()
+
+    for i in range(0, len(ids), chunk_size):
+        query = {id_field: {"$in": ids[i:i + chunk_size]}, **(done_filter or {})}
+        for doc in coll.find(query, {id_field: 1, "_id": 0}):
+            done.add(doc[id_field])
+
+    print(f"🗂️ Already done → {len(done)} of {len(ids)} ids")
+    return done
+
+
+def load_unchanged_ids(coll, versions, done_filter=None, chunk_size=10000):
+    """Return the ContentDocumentIds whose tracked file still matches Salesforce.
+
+    versions maps ContentDocumentId → (ContentVersion Id, Checksum, ContentSize).
+    A tracked doc is unchanged when all three match, so a new version is
+    migrated again. Docs tracked before these fields were recorded have
+    nothing to compare against and count as unchanged.
+    """
+    ids = [doc_id for doc_id in versions if doc_id]
+    fields = ("ContentVersionId__c", "SF_Checksum__c", "File_Size")
+    unchanged = set()
+
+    for i in range(0, len(ids), chunk_size):
+        query = {"ContentDocumentId__c": {"$in": ids[i:i + chunk_size]}, **(done_filter or {})}
+        projection = {"_id": 0, "ContentDocumentId__c": 1, **{field: 1 for field in fields}}
+
+        for doc in coll.find(query, projection):
+            doc_id = doc["ContentDocumentId__c"]
+            if "ContentVersionId__c" not in doc:
+                unchanged.add(doc_id)
+            elif tuple(doc.get(field) for field in fields) == tuple(versions[doc_id]):
+                unchanged.add(doc_id)
+
+    print(f"🗂️ Unchanged since last run → {len(unchanged)} of {len(ids)} files")
+    return unchanged
+
+
+# ---------------- CONTENT DEDUPE ----------------
+DEDUPE_POLICIES = ("off", "reference", "register")
+
+
+def ensure_checksum_index(coll):
+    """Index uploaded bytes by SHA-1 + size, and by Salesforce's own Checksum + size."""
+    coll.create_index([("Checksum__c", 1), ("File_Size", 1)], name="checksum_size_idx")
+    coll.create_index([("SF_Checksum__c", 1), ("File_Size", 1)], name="sf_checksum_size_idx", sparse=True)
+
+
+def find_uploaded_blob(coll, size, checksum=None, sf_checksum=None):
+    """Return the tracking doc of a file already in DMS with the same bytes, or None.
+
+    checksum is our SHA-1 of the downloaded bytes; sf_checksum is
+    ContentVersion.Checksum, which allows the match before downloading.
+    """
+    if checksum:
+        query = {"Checksum__c": checksum, "File_Size": size}
+    elif sf_checksum:
+        query = {"SF_Checksum__c": sf_checksum, "File_Size": size}
+    else:
+        return None
+
+    query["Migrate_Status__c"] = "SuccessToDMS"
+    return coll.find_one(
+        query,
+        {"_id": 0, "ContentDocumentId__c": 1, "Checksum__c": 1, "DMS_Response__c": 1, "Duplicate_Of__c": 1}
+    )
+
+
+def resolve_duplicate(original, policy, register_url=None, headers=None, metadata=None, timeout=120, session=requests):
+    """Settle a file whose bytes are already in DMS; returns (status, response_text, tracking fields).
+
+    "reference" points the record at the original's DMS entry without any
+    DMS call. "register" posts only the metadata to register_url so DMS
+    indexes the record against the existing blob.
+    """
+    fields = {
+        "Duplicate_Of__c": original.get("Duplicate_Of__c") or original["ContentDocumentId__c"],
+        "Dedupe_Policy__c": policy
+    }
+
+    if policy == "register":
+        res = session.post(
+            register_url,
+            headers=headers,
+            json={**metadata, "duplicateOf": fields["Duplicate_Of__c"]},
+            timeout=timeout
+        )
+        status = "SuccessToDMS" if res.status_code in [200, 201] else "FailedToDMS"
+        return status, res.text, fields
+
+    return "SuccessToDMS", original.get("DMS_Response__c"), fields
+
+
+def dedupe_policy(policy, register_url=None):
+    """Validate the configured dedupe policy; "register" without an endpoint falls back to "reference"."""
+    policy = (policy or "off").lower()
+    if policy not in DEDUPE_POLICIES:
+        raise ValueError(f"DMS_DEDUPE_POLICY must be one of {DEDUPE_POLICIES}, got {policy!r}")
+
+    if policy == "register" and not register_url:
+        print("⚠️ DMS_DEDUPE_POLICY=register needs DMS_REGISTER_ENDPOINT; using reference")
+        return "reference"
+
+    return policy
+
+
+# ---------------- RETRY POLICY ----------------
+class RetryExhausted(Exception):
+    """Raised when every attempt ended in a timeout or connection error."""
+
+    def __init__(self, message, attempts, retry_seconds):
+        super().__init__(message)
+        self.attempts = attempts
+        self.retry_seconds = retry_seconds
+
+
+def _retry_after_seconds(response):
+    value = response.headers.get("Retry-After")
+    if not value:
+        return None
+    try:
+        return max(0.0, float(value))
+    except ValueError:
+        pass
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError):
+        return None
+
+
+class RetryPolicy:
+    """Shared retry rules for DMS calls.
+
+    Connect/read timeouts and dropped connections draw on timeout_retries;
+    429 and 5xx responses draw on error_retries, waiting for Retry-After
+    when the gateway sends one. Anything else, a 4xx validation error
+    included, is returned straight away. Waits are exponential with full
+    jitter, capped at max_delay.
+    """
+
+    RETRY_STATUSES = (429, 500, 502, 503, 504)
+
+    def __init__(self, timeout_retries=2, error_retries=4, base_delay=1.0, max_delay=60.0):
+        self.timeout_retries = timeout_retries
+        self.error_retries = error_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+
+    def _backoff(self, retry):
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** retry))
+
+    def call(self, send, rewind=None):
+        """Run send() until it settles; returns (response, attempts, retry_seconds).
+
+        rewind is a file object seeked back to 0 before every attempt, for
+        bodies that are read as they are sent. retry_seconds is the time
+        spent on failed attempts and waits before the final one.
+        """
+        first_start = time.monotonic()
+        timeouts = errors = 0
+        attempts = 0
+
+        while True:
+            attempts += 1
+            attempt_start = time.monotonic()
+            if rewind is not None:
+                rewind.seek(0)
+
+            try:
+                response = send()
+            except (requests.exceptions.Timeout, requests.exceptions.ConnectionError) as e:
+                if timeouts >= self.timeout_retries:
+                    raise RetryExhausted(
+                        f"{e} (after {attempts} attempts)", attempts, round(attempt_start - first_start, 3)
+                    ) from e
+                delay = self._backoff(timeouts)
+                timeouts += 1
+                print(f"⏳ {type(e).__name__}, retry {timeouts}/{self.timeout_retries} in {delay:.1f}s")
+                time.sleep(delay)
+                continue
+
+            if response.status_code not in self.RETRY_STATUSES or errors >= self.error_retries:
+                return response, attempts, round(attempt_start - first_start, 3)
+
+            retry_after = _retry_after_seconds(response)
+            delay = min(retry_after, self.max_delay * 5) if retry_after is not None else self._backoff(errors)
+            errors += 1
+            print(f"⏳ HTTP {response.status_code}, retry {errors}/{self.error_retries} in {delay:.1f}s")
+            time.sleep(delay)
+
+
+# ---------------- ADAPTIVE CONCURRENCY ----------------
+class AdaptiveLimiter:
+    """AIMD limit on how many calls run at once against one endpoint.
+
+    Every window calls the limiter looks at p95 latency and the share of
+    failures (no response, 429 or 5xx): while both stay under target the
+    limit grows by one, otherwise it is cut by decrease. Callers block in
+    acquire() while the limit is reached, so the worker pool only sets the
+    ceiling. The current limit is printed every log_interval seconds.
+    """
+
+    def __init__(self, name, initial, minimum=1, maximum=None, target_p95=30.0,
+                 max_error_rate=0.05, window=20, decrease=0.5, log_interval=60):
+        self.name = name
+        self.minimum = minimum
+        self.maximum = maximum or initial
+        self.limit = max(minimum, min(initial, self.maximum))
+        self.target_p95 = target_p95
+        self.max_error_rate = max_error_rate
+        self.window = window
+        self.decrease = decrease
+        self.log_interval = log_interval
+        self.in_flight = 0
+        self._samples = []
+        self._last_log = time.monotonic()
+        self._cond = threading.Condition()
+
+    def acquire(self):
+        with self._cond:
+            while self.in_flight >= self.limit:
+                self._cond.wait()
+            self.in_flight += 1
+        return time.monotonic()
+
+    def release(self, started, status_code=None):
+        """Record one call started at acquire()'s timestamp; status_code None means it never got a response."""
+        failed = status_code is None or status_code == 429 or status_code >= 500
+
+        with self._cond:
+            self.in_flight -= 1
+            self._samples.append((time.monotonic() - started, failed))
+
+            if len(self._samples) >= self.window:
+                latencies = sorted(latency for latency, _ in self._samples)
+                p95 = latencies[max(0, int(len(latencies) * 0.95) - 1)]
+                error_rate = sum(failed for _, failed in self._samples) / len(self._samples)
+                self._samples = []
+
+                if p95 <= self.target_p95 and error_rate <= self.max_error_rate:
+                    self.limit = min(self.maximum, self.limit + 1)
+                else:
+                    self.limit = max(self.minimum, int(self.limit * self.decrease))
+                    print(f"🐢 {self.name} backing off → limit {self.limit} (p95 {p95:.1f}s, errors {error_rate:.0%})")
+
+            if time.monotonic() - self._last_log >= self.log_interval:
+                self._last_log = time.monotonic()
+                print(f"🎚️ {self.name} limit {self.limit} ({self.in_flight} in flight)")
+
+            self._cond.notify_all()
+
+
+# ---------------- DMS JOB QUEUE ----------------
+class JobQueue:
+    """Mongo-backed DMS work queue that any number of worker processes can drain.
+
+    One document per ContentDocumentId moves Pending → InProgress →
+    SuccessToDMS / FailedToDMS. lease() claims a job atomically with
+    find_one_and_update and stamps it with this worker and a lease expiry;
+    a heartbeat thread keeps extending the leases this worker holds, so a
+    job only goes back to the pool when its worker dies. A job whose lease
+    expires after max_attempts leases is marked FailedToDMS instead.
+    """
+
+    def __init__(self, coll, lease_seconds=600, max_attempts=5, worker_id=None):
+        self.coll = coll
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self.worker_id = worker_id or f"{socket.gethostname()}:{os.getpid()}"
+        self._held = set()
+        self._lock = threading.Lock()
+        self._stop = threading.Event()
+        self._heartbeat = None
+
+        coll.create_index([("status", 1), ("lease_expires", 1)], name="status_lease_idx")
+
+    def _now(self):
+        return datetime.now(timezone.utc)
+
+    def enqueue(self, rows, batch_size=1000):
+        """Add one Pending job per row keyed by ContentDocumentId; jobs already queued are left alone."""
+        added = 0
+        ops = []
+
+        def flush():
+            nonlocal added
+            if ops:
+                added += self.coll.bulk_write(ops, ordered=False).upserted_count
+                ops.clear()
+
+        for row in rows:
+            doc_id = row.get("ContentDocumentId")
+            if not doc_id:
+                continue
+            ops.append(UpdateOne(
+                {"_id": doc_id},
+                {"$setOnInsert": {"status": "Pending", "row": row, "attempts": 0, "created_at": self._now()}},
+                upsert=True
+            ))
+            if len(ops) >= batch_size:
+                flush()
+
+        flush()
+        return added
+
+    def lease(self):
+        """Claim the next Pending (or lease-expired) job for this worker; returns it or None."""
+        now = self._now()
+        job = self.coll.find_one_and_update(
+            {
+                "attempts": {"$lt": self.max_attempts},
+                "$or": [
+                    {"status": "Pending"},
+                    {"status": "InProgress", "lease_expires": {"$lt": now}}
+                ]
+            },
+            {
+                "$set": {
+                    "status": "InProgress",
+                    "worker": self.worker_id,
+                    "leased_at": now,
+                    "lease_expires": now + timedelta(seconds=self.lease_seconds)
+                },
+                "$inc": {"attempts": 1}
+            },
+            return_document=ReturnDocument.AFTER
+        )
+
+        if job:
+            with self._lock:
+                self._held.add(job["_id"])
+        else:
+            self.fail_exhausted()
+        return job
+
+    def fail_exhausted(self):
+        """Mark lease-expired jobs with no attempts left FailedToDMS so they do not sit InProgress forever."""
+        now = self._now()
+        return self.coll.update_many(
+            {"status": "InProgress", "lease_expires": {"$lt": now}, "attempts": {"$gte": self.max_attempts}},
+            {
+                "$set": {
+                    "status": "FailedToDMS",
+                    "last_error": f"lease expired after {self.max_attempts} attempts",
+                    "finished_at": now
+                },
+                "$unset": {"lease_expires": ""}
+            }
+        ).modified_count
+
+    def complete(self, job_id, status, result=None):
+        """Finish a job this worker still holds; a job that already finished or was re-leased is left alone."""
+        self.coll.update_one(
+            {"_id": job_id, "status": "InProgress", "worker": self.worker_id},
+            {
+                "$set": {"status": status, "result": result, "finished_at": self._now()},
+                "$unset": {"lease_expires": ""}
+            }
+        )
+        with self._lock:
+            self._held.discard(job_id)
+
+    def _beat(self):
+        while not self._stop.wait(self.lease_seconds / 3):
+            with self._lock:
+                held = list(self._held)
+            if held:
+                self.coll.update_many(
+                    {"_id": {"$in": held}, "status": "InProgress", "worker": self.worker_id},
+                    {"$set": {"lease_expires": self._now() + timedelta(seconds=self.lease_seconds)}}
+                )
+
+    def start_heartbeat(self):
+        self._heartbeat = threading.Thread(target=self._beat, name="dms-queue-heartbeat", daemon=True)
+        self._heartbeat.start()
+
+    def stop_heartbeat(self):
+        self._stop.set()
+        if self._heartbeat:
+            self._heartbeat.join()
+
+    def requeue(self, status="FailedToDMS"):
+        """Send finished jobs with status back to Pending with a fresh attempt budget."""
+        if status == "FailedToDMS":
+            self.fail_exhausted()
+        return self.coll.update_many(
+            {"status": status},
+            {"$set": {"status": "Pending", "attempts": 0}, "$unset": {"worker": "", "lease_expires": ""}}
+        ).modified_count
+
+    def counts(self):
+        return {row["_id"]: row["count"] for row in self.coll.aggregate([
+            {"$group": {"_id": "$status", "count": {"$sum": 1}}}
+        ])}
+
+
+# ---------------- STAGED PIPELINE ----------------
+def run_stages(items, stages, max_in_flight=32, on_result=print, on_finish=None):
+    """Push every item through stages, each stage on its own bounded thread pool.
+
+    stages is a list of (name, fn, workers). A stage returns a dict to hand the
+    job to the next stage, or a message to finish it early; the last stage's
+    return value is the item's result. At most max_in_flight items are between
+    the first and the last stage, so a slow stage never piles up work in memory.
+    on_finish(item, result), when given, runs once per item after on_result.
+    """
+    pools = [
+        ThreadPoolExecutor(max_workers=workers, thread_name_prefix=name)
+        for name, _, workers in stages
+    ]
+    slots = threading.BoundedSemaphore(max_in_flight)
+
+    def advance(index, job, item):
+        name, fn, _ = stages[index]
+        try:
+            result = fn(job)
+        except Exception as e:
+            result = f"❌ ERROR [{name}]: {e}"
+
+        if isinstance(result, dict) and index + 1 < len(stages):
+            pools[index + 1].submit(advance, index + 1, result, item)
+            return
+
+        try:
+            on_result(result)
+            if on_finish:
+                on_finish(item, result)
+        finally:
+            slots.release()
+
+    try:
+        for item in items:
+            slots.acquire()
+            pools[0].submit(advance, 0, item, item)
+
+        # Every slot back means every item has left the last stage
+        for _ in range(max_in_flight):
+            slots.acquire()
+    finally:
+        for pool in pools:
+            pool.shutdown()
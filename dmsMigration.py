@@ -1,10 +1,10 @@
 import os
 import json
-import requests
 from dotenv import load_dotenv
 from datetime import datetime
 from simple_salesforce import Salesforce
 from pymongo import MongoClient
+from dmsHelpers import ParentCache, key_prefix_map, HttpTransport
 
 # ---------------- CONFIG ---------------- #
 load_dotenv()
@@ -25,8 +25,13 @@ DMS_METHOD = os.getenv("DMS_METHOD", "POST")
 DMS_TIMEOUT = int(os.getenv("DMS_TIMEOUT", 120))
 DMS_HEADERS = json.loads(os.getenv("DMS_HEADERS"))["Headers"]
 
+PARENT_CACHE_SIZE = int(os.getenv("DMS_PARENT_CACHE_SIZE", 10000))
+PARENT_CACHE_TTL = int(os.getenv("DMS_PARENT_CACHE_TTL", 900))  # seconds
+
 os.makedirs(TEMP_DIR, exist_ok=True)
 
+transport = HttpTransport()  # keep-alive sessions for the Salesforce download and DMS hosts
+
 # print(SF_USERNAME)
 # print(SF_PASSWORD)
 # # print(SF_TOKEN)
@@ -45,6 +50,10 @@ print("✅ Salesforce connected")
 mongo = MongoClient(MONGO_URI)
 collection = mongo[DB_NAME][COLLECTION]
 
+# Parents shared by several files are queried once; key prefixes resolve the sObject to query
+parent_cache = ParentCache(fields=("Vertical__c",), max_size=PARENT_CACHE_SIZE, ttl=PARENT_CACHE_TTL)
+sobject_types = key_prefix_map(sf)
+
 # ---------------- INPUT ---------------- #
 start_date = input("Start Date (YYYY-MM-DD): ")
 end_date = input("End Date (YYYY-MM-DD): ")
@@ -84,14 +93,8 @@ for file in files:
         linked_entity_id = cdl[0]["LinkedEntityId"] if cdl else None
         sobject_name = linked_entity_id[:3] if linked_entity_id else None
 
-        vertical = "UNKNOWN"
-        if linked_entity_id:
-            try:
-                obj = sf.query(f"SELECT Vertical__c FROM {sobject_name} WHERE Id='{linked_entity_id}'")
-                if obj["records"]:
-                    vertical = obj["records"][0].get("Vertical__c", "UNKNOWN")
-            except:
-                pass
+        parent, cache_hit = parent_cache.lookup(sf, sobject_types.get(sobject_name), linked_entity_id)
+        vertical = parent.get("Vertical__c", "UNKNOWN")
 
         # ---- Mongo check ---- #
         mongo_rec = collection.find_one({
@@ -106,7 +109,7 @@ for file in files:
         download_url = f"{sf.base_url}sobjects/ContentVersion/{content_version_id}/VersionData"
         headers = {"Authorization": f"Bearer {sf.session_id}"}
 
-        response = requests.get(download_url, headers=headers)
+        response = transport.get(download_url, headers=headers)
         response.raise_for_status()
 
         file_name = f"{content_document_id}_{file['Title']}.{file['FileExtension']}"
@@ -123,6 +126,7 @@ for file in files:
                 "linked_entity_id": linked_entity_id,
                 "sobject_name": sobject_name,
                 "vertical": vertical,
+                "parent_cache_hit": cache_hit,
                 "local_path": local_path,
                 "pushed_to_dms": False,
                 "updated_at": datetime.utcnow()
@@ -132,7 +136,7 @@ for file in files:
 
         # ---- Push to DMS ---- #
         with open(local_path, "rb") as f:
-            dms_response = requests.post(
+            dms_response = transport.post(
     DMS_ENDPOINT,
     headers=DMS_HEADERS,
     files={"file": f},
@@ -156,4 +160,6 @@ for file in files:
     except Exception as e:
         print(f"✖ ERROR → {file['Title']} : {e}")
 
+print(f"📚 Parent cache → {parent_cache.stats()}")
+print(f"🌐 HTTP pools → {transport.stats()}")
 print("\n✔ Processing Completed")
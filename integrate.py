@@ -83,7 +83,10 @@ from datetime import datetime, timezone
 from pymongo import MongoClient, UpdateOne
 from simple_salesforce import Salesforce
 from dotenv import load_dotenv
-from collections import defaultdict
+from syncHelpers import (
+    query_records, grouped_batches, ensure_sf_id_index,
+    ApiCallBudget, BudgetedSalesforce, count_records, run_object_syncs
+)
 
 # -----------------------------------
 # Load Environment Variables
@@ -95,6 +98,10 @@ SF_USERNAME = os.getenv("SF_USERNAME")
 SF_PASSWORD = os.getenv("SF_PASSWORD")
 SF_SECURITY_TOKEN = os.getenv("SF_SECURITY_TOKEN")
 SF_DOMAIN = os.getenv("SF_DOMAIN", "login")
+SF_API_CALL_BUDGET = int(os.getenv("SF_API_CALL_BUDGET", 0))  # 0 = unlimited
+SYNC_MAX_OBJECTS = int(os.getenv("SYNC_MAX_OBJECTS", 3))
+SYNC_FLUSH_SIZE = int(os.getenv("SYNC_FLUSH_SIZE", 2000))        # records per group before a Mongo flush
+SYNC_MAX_BUFFERED = int(os.getenv("SYNC_MAX_BUFFERED", 10000))   # records held across all groups
 
 # -----------------------------------
 # Connect to Salesforce and MongoDB
@@ -180,67 +187,82 @@ def sync_salesforce_object(sobject_name, base_query):
     last_sync = get_last_sync(sobject_name)
     # Build SOQL query dynamically based on checkpoint
     if last_sync:
-        soql = f"{base_query} WHERE SystemModstamp > {last_sync} ORDER BY SystemModstamp ASC LIMIT 50000"
+        soql = f"{base_query} WHERE SystemModstamp > {last_sync} ORDER BY SystemModstamp ASC"
     else:
-        soql = f"{base_query} ORDER BY SystemModstamp ASC LIMIT 50000"
-
-    try:
-        result = sf.query_all(soql)
-        records = result["records"]
-        print(f"Fetched {len(records)} records from {sobject_name}")
-    except Exception as e:
-        print(f"❌ Failed to fetch records for {sobject_name}: {e}")
-        return
+        soql = f"{base_query} ORDER BY SystemModstamp ASC"
 
-    if not records:
-        print("No new or updated records found.")
-        return
+    records = query_records(sf, soql)
 
     # Group by sObject_Record_Id__c (push all related records into one collection)
-    grouped_records = defaultdict(list)
-    for rec in records:
-        rec.pop("attributes", None)
-        group_id = rec.get("sObject_Record_Id__c") or "default"
-        coll_name = f"{sobject_name}_{group_id}".replace(".", "_")
-        grouped_records[coll_name].append(rec)
+    def keyed(records):
+        for rec in records:
+            rec.pop("attributes", None)
+            group_id = rec.get("sObject_Record_Id__c") or "default"
+            yield f"{sobject_name}_{group_id}".replace(".", "_"), rec
 
+    total_fetched = 0
     total_upserts = 0
     newest_modstamp = None
 
-    # Push to MongoDB per group
-    for coll_name, docs in grouped_records.items():
-        collection = db[coll_name]
-        collection.create_index("Id", unique=True)
-        ops = [
-            UpdateOne({"Id": d["Id"]}, {"$set": d}, upsert=True)
-            for d in docs
-        ]
-        if ops:
-            result = collection.bulk_write(ops, ordered=False)
-            count = (result.upserted_count or 0) + (result.modified_count or 0)
-            total_upserts += count
-            print(f"✅ {coll_name}: {count} upserts")
-
-        # Track latest SystemModstamp
-        latest_doc = max(d["SystemModstamp"] for d in docs if "SystemModstamp" in d)
-        if newest_modstamp is None or latest_doc > newest_modstamp:
-            newest_modstamp = latest_doc
+    # Push to MongoDB whenever a group reaches the flush threshold
+    try:
+        for coll_name, docs in grouped_batches(keyed(records), SYNC_FLUSH_SIZE, SYNC_MAX_BUFFERED):
+            total_fetched += len(docs)
+            collection = db[coll_name]
+            ensure_sf_id_index(collection)
+            ops = [
+                UpdateOne({"Id": d["Id"]}, {"$set": d}, upsert=True)
+                for d in docs
+            ]
+            if ops:
+                result = collection.bulk_write(ops, ordered=False)
+                count = (result.upserted_count or 0) + (result.modified_count or 0)
+                total_upserts += count
+                print(f"✅ {coll_name}: {count} upserts")
+
+            # Track latest SystemModstamp
+            latest_doc = max(d["SystemModstamp"] for d in docs if "SystemModstamp" in d)
+            if newest_modstamp is None or latest_doc > newest_modstamp:
+                newest_modstamp = latest_doc
+
+    except Exception as e:
+        # Checkpoint is not advanced: unflushed groups may hold older records.
+        # Re-raised so run_object_syncs reports the object as failed
+        print(f"❌ Failed to sync records for {sobject_name}: {e}")
+        raise
+
+    print(f"Fetched {total_fetched} records from {sobject_name}")
+
+    if not total_fetched:
+        print("No new or updated records found.")
+        return 0
 
     # Update checkpoint with last SystemModstamp
     if newest_modstamp:
         update_checkpoint(sobject_name, newest_modstamp)
 
     print(f"🔹 {sobject_name}: {total_upserts} records upserted.")
+    return total_upserts
 
 
 # -----------------------------------
 # Run Sync for All Objects
 # -----------------------------------
 if __name__ == "__main__":
-    for obj_name, soql in OBJECT_QUERIES.items():
-        try:
-            sync_salesforce_object(obj_name, soql)
-        except Exception as e:
-            print(f"❌ Error syncing {obj_name}: {e}")
+    sf = BudgetedSalesforce(sf, ApiCallBudget(SF_API_CALL_BUDGET))
 
-    print("\n🎯 All Salesforce objects synced successfully!")
+    summary = run_object_syncs(
+        sync_salesforce_object,
+        OBJECT_QUERIES,
+        SYNC_MAX_OBJECTS,
+        size_fn=lambda obj_name, soql: count_records(sf, soql)
+    )
+
+    for row in summary:
+        if row["error"]:
+            print(f"❌ Error syncing {row['object']}: {row['error']}")
+
+    if any(row["error"] for row in summary):
+        print("\n⚠️ Salesforce sync finished with errors, see the summary above")
+    else:
+        print("\n🎯 All Salesforce objects synced successfully!")
@@ -3,8 +3,11 @@ from datetime import datetime, timezone
 from pymongo import MongoClient, UpdateOne
 from simple_salesforce import Salesforce
 from dotenv import load_dotenv
-from collections import defaultdict
 from simple_salesforce.exceptions import SalesforceMalformedRequest
+from syncHelpers import (
+    query_records, grouped_batches, ensure_sf_id_index,
+    ApiCallBudget, BudgetedSalesforce, count_records, run_object_syncs, BufferedWriter
+)
 
 # -----------------------------------
 # Load Environment Variables
@@ -16,6 +19,13 @@ SF_USERNAME = os.getenv("SF_USERNAME")
 SF_PASSWORD = os.getenv("SF_PASSWORD")
 SF_SECURITY_TOKEN = os.getenv("SF_SECURITY_TOKEN")
 SF_DOMAIN = os.getenv("SF_DOMAIN", "login")
+SF_API_CALL_BUDGET = int(os.getenv("SF_API_CALL_BUDGET", 0))  # 0 = unlimited
+SYNC_MAX_OBJECTS = int(os.getenv("SYNC_MAX_OBJECTS", 3))
+SYNC_FLUSH_SIZE = int(os.getenv("SYNC_FLUSH_SIZE", 2000))        # records per vertical before a Mongo flush
+SYNC_MAX_BUFFERED = int(os.getenv("SYNC_MAX_BUFFERED", 10000))   # records held across all verticals
+SYNC_ERROR_BATCH_SIZE = int(os.getenv("SYNC_ERROR_BATCH_SIZE", 500))
+SYNC_ERROR_FLUSH_SECONDS = int(os.getenv("SYNC_ERROR_FLUSH_SECONDS", 5))
+SF_EXTRACT_MODE = os.getenv("SF_EXTRACT_MODE", "rest")  # rest | bulk (Bulk API 2.0)
 
 # -----------------------------------
 # Connect to Salesforce and MongoDB
@@ -33,6 +43,7 @@ db = mongo_client.get_database()
 
 checkpoint_coll = db["_sync_metadata"]      # To track last sync timestamps
 error_coll = db["_sync_errors"]             # To store error logs
+error_sink = BufferedWriter(error_coll, SYNC_ERROR_BATCH_SIZE, SYNC_ERROR_FLUSH_SECONDS)
 
 # -----------------------------------
 # Salesforce Object Configurations
@@ -162,7 +173,7 @@ def update_checkpoint(sobject_name, newest_time):
 
 
 def log_error(sobject_name, record_id, stage, message, record_data=None):
-    """Store detailed error logs in MongoDB."""
+    """Queue an error log for the next batched insert into MongoDB."""
     error_doc = {
         "sobject_name": sobject_name,
         "record_id": record_id,
@@ -171,99 +182,122 @@ def log_error(sobject_name, record_id, stage, message, record_data=None):
         "record_data": record_data or {},
         "timestamp": datetime.now(timezone.utc)
     }
-    try:
-        error_coll.insert_one(error_doc)
-        print(f" Logged error for {sobject_name} ({record_id}) at {stage}")
-    except Exception as e:
-        print(f" Failed to write error log to MongoDB: {e}")
+    error_sink.insert_one(error_doc)
+    print(f" Logged error for {sobject_name} ({record_id}) at {stage}")
 
 # -----------------------------------
 # Core Sync Function
 # -----------------------------------
+def write_group(sobject_name, coll_name, docs):
+    """Upsert one batch into its vertical collection; returns (count, latest SystemModstamp)."""
+    count = 0
+    collection = db[coll_name]
+    ensure_sf_id_index(collection)
+    ops = [UpdateOne({"Id": d["Id"]}, {"$set": d}, upsert=True) for d in docs]
+    try:
+        result = collection.bulk_write(ops, ordered=False)
+        count = (result.upserted_count or 0) + (result.modified_count or 0)
+        print(f" {coll_name}: {count} records upserted in MongoDB")
+
+# -------------------------------------------------------------
+# Delete previous error logs for successfully upserted records
+# -------------------------------------------------------------
+        record_ids = [d["Id"] for d in docs]
+        error_sink.flush()  # queued errors for these Ids must land before they are cleared
+        deleted_result = error_coll.delete_many({
+            "sobject_name": sobject_name,
+            "record_id": {"$in": record_ids}
+        })
+        if deleted_result.deleted_count:
+            print(f" Deleted {deleted_result.deleted_count} previous error logs for {coll_name}")
+
+    except Exception as e:
+        # Reference the target collection instead of copying every record into the log
+        for d in docs:
+            log_error(sobject_name, d.get("Id"), "Mongo Upsert", e, {"collection": coll_name})
+
+    latest_doc = max(
+        (d.get("SystemModstamp") for d in docs if d.get("SystemModstamp")),
+        default=None
+    )
+    return count, latest_doc
+
+
 def sync_salesforce_object(sobject_name, base_query):
     print(f"\n Syncing {sobject_name} ...")
 
     last_sync = get_last_sync(sobject_name)
     # Build SOQL query dynamically based on checkpoint
     if last_sync:
-        soql = f"{base_query} WHERE SystemModstamp > {last_sync.isoformat()} ORDER BY SystemModstamp ASC LIMIT 50000"
+        soql = f"{base_query} WHERE SystemModstamp > {last_sync.isoformat()} ORDER BY SystemModstamp ASC"
     else:
-        soql = f"{base_query} ORDER BY CreatedDate ASC LIMIT 50000"
+        soql = f"{base_query} ORDER BY CreatedDate ASC"
 
-    try:
-        result = sf.query_all(soql)
-        records = result["records"]
-        print(f" Fetched {len(records)} records from {sobject_name}")
-    except Exception as e:
-        log_error(sobject_name, None, "Salesforce Query", e)
-        print(f" Failed to fetch records for {sobject_name}: {e}")
-        return
+    records = query_records(sf, soql, SF_EXTRACT_MODE)
 
-    if not records:
-        print(f"No new or updated records found for {sobject_name}.")
-        return
-
-    # Group by Vertical__c (SME, LAP, HL)
-    grouped_records = defaultdict(list)
-    for rec in records:
-        rec.pop("attributes", None)
-        vertical = (rec.get("Vertical__c") or "Unknown").strip().upper()
-        if vertical not in ["SME", "LAP", "HL"]:
-            vertical = "Other"
-        coll_name = f"{sobject_name}_{vertical}".replace(".", "_")
-        grouped_records[coll_name].append(rec)
+    # Group by Vertical__c (SME, LAP, HL) while the records stream in
+    def keyed(records):
+        for rec in records:
+            rec.pop("attributes", None)
+            vertical = (rec.get("Vertical__c") or "Unknown").strip().upper()
+            if vertical not in ["SME", "LAP", "HL"]:
+                vertical = "Other"
+            yield f"{sobject_name}_{vertical}".replace(".", "_"), rec
 
+    total_fetched = 0
     total_upserts = 0
     newest_modstamp = None
 
-    # Push to MongoDB per group
-    for coll_name, docs in grouped_records.items():
-        collection = db[coll_name]
-        collection.create_index("Id", unique=True)
-        ops = [UpdateOne({"Id": d["Id"]}, {"$set": d}, upsert=True) for d in docs]
-        try:
-            result = collection.bulk_write(ops, ordered=False)
-            count = (result.upserted_count or 0) + (result.modified_count or 0)
+    # Push to MongoDB whenever a group reaches the flush threshold
+    try:
+        for coll_name, docs in grouped_batches(keyed(records), SYNC_FLUSH_SIZE, SYNC_MAX_BUFFERED):
+            total_fetched += len(docs)
+            count, latest_doc = write_group(sobject_name, coll_name, docs)
             total_upserts += count
-            print(f" {coll_name}: {count} records upserted in MongoDB")
 
-# -------------------------------------------------------------
-# Delete previous error logs for successfully upserted records
-# -------------------------------------------------------------
-            record_ids = [d["Id"] for d in docs]
-            deleted_result = error_coll.delete_many({
-                "sobject_name": sobject_name,
-                "record_id": {"$in": record_ids}
-            })
-            if deleted_result.deleted_count:
-                print(f" Deleted {deleted_result.deleted_count} previous error logs for {coll_name}")
-
-        except Exception as e:
-            for d in docs:
-                log_error(sobject_name, d.get("Id"), "Mongo Upsert", e, d)
-
-        # Track latest SystemModstamp
-        latest_doc = max(
-            (d.get("SystemModstamp") for d in docs if d.get("SystemModstamp")),
-            default=None
-        )
-        if latest_doc and (newest_modstamp is None or latest_doc > newest_modstamp):
-            newest_modstamp = latest_doc
+            # Track latest SystemModstamp
+            if latest_doc and (newest_modstamp is None or latest_doc > newest_modstamp):
+                newest_modstamp = latest_doc
+
+    except Exception as e:
+        # Checkpoint is not advanced: unflushed groups may hold older records.
+        # Re-raised so run_object_syncs reports the object as failed (logged by main)
+        print(f" Failed to fetch records for {sobject_name}: {e}")
+        raise
+
+    print(f" Fetched {total_fetched} records from {sobject_name}")
+
+    if not total_fetched:
+        print(f"No new or updated records found for {sobject_name}.")
+        return 0
 
     # Update checkpoint with last SystemModstamp
     if newest_modstamp:
         update_checkpoint(sobject_name, newest_modstamp)
 
     print(f" {sobject_name}: {total_upserts} records successfully processed.")
+    return total_upserts
 
 # -----------------------------------
 # Main Execution
 # -----------------------------------
 if __name__ == "__main__":
-    for obj_name, soql in OBJECT_QUERIES.items():
-        try:
-            sync_salesforce_object(obj_name, soql)
-        except Exception as e:
-            log_error(obj_name, None, "Main Sync Loop", e)
+    sf = BudgetedSalesforce(sf, ApiCallBudget(SF_API_CALL_BUDGET))
+
+    summary = run_object_syncs(
+        sync_salesforce_object,
+        OBJECT_QUERIES,
+        SYNC_MAX_OBJECTS,
+        size_fn=lambda obj_name, soql: count_records(sf, soql)
+    )
+
+    for row in summary:
+        if row["error"]:
+            log_error(row["object"], None, "Main Sync Loop", row["error"])
 
-    print("\n All Salesforce objects synced successfully!")
+    error_sink.close()
+
+    if any(row["error"] for row in summary):
+        print("\n Salesforce sync finished with errors, see the summary above")
+    else:
+        print("\n All Salesforce objects synced successfully!")
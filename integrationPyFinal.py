@@ -1,9 +1,16 @@
 import os
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from pymongo import MongoClient, UpdateOne
+from pymongo.errors import BulkWriteError
 from simple_salesforce import Salesforce
 from dotenv import load_dotenv
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from syncHelpers import (
+    ensure_sf_id_index, ensure_all_indexes, query_pages, prefetch_pages, patch_migrated_flags,
+    ApiCallBudget, BudgetedSalesforce, count_records, run_object_syncs,
+    parse_sf_datetime, first_modstamp, window_soql, run_windowed_sync, BufferedWriter
+)
 
 # -----------------------------------
 # Load Environment Variables
@@ -15,6 +22,16 @@ SF_USERNAME = os.getenv("SF_USERNAME")
 SF_PASSWORD = os.getenv("SF_PASSWORD")
 SF_SECURITY_TOKEN = os.getenv("SF_SECURITY_TOKEN")
 SF_DOMAIN = os.getenv("SF_DOMAIN", "login")
+SF_EXTRACT_MODE = os.getenv("SF_EXTRACT_MODE", "rest")  # rest | bulk (Bulk API 2.0)
+SYNC_PREFETCH_PAGES = int(os.getenv("SYNC_PREFETCH_PAGES", 2))
+SYNC_WRITE_WORKERS = int(os.getenv("SYNC_WRITE_WORKERS", 4))
+FLAG_PATCH_WORKERS = int(os.getenv("FLAG_PATCH_WORKERS", 4))
+SF_API_CALL_BUDGET = int(os.getenv("SF_API_CALL_BUDGET", 0))  # 0 = unlimited
+SYNC_MAX_OBJECTS = int(os.getenv("SYNC_MAX_OBJECTS", 3))
+SYNC_WINDOW_DAYS = int(os.getenv("SYNC_WINDOW_DAYS", 30))
+SYNC_WINDOW_WORKERS = int(os.getenv("SYNC_WINDOW_WORKERS", 4))
+SYNC_ERROR_BATCH_SIZE = int(os.getenv("SYNC_ERROR_BATCH_SIZE", 500))
+SYNC_ERROR_FLUSH_SECONDS = int(os.getenv("SYNC_ERROR_FLUSH_SECONDS", 5))
 
 # -----------------------------------
 # Connect to Salesforce
@@ -36,6 +53,7 @@ print(f"✅ Connected to MongoDB DB: {db.name}")
 
 checkpoint_coll = db["_sync_metadata"]
 error_coll = db["_sync_errors"]
+error_sink = BufferedWriter(error_coll, SYNC_ERROR_BATCH_SIZE, SYNC_ERROR_FLUSH_SECONDS)
 
 # -----------------------------------
 # Salesforce Object Queries
@@ -307,7 +325,7 @@ def update_checkpoint(sobject_name, timestamp):
 
 
 def log_error(sobject, record_id, stage, error, record=None):
-    error_coll.insert_one({
+    error_sink.insert_one({
         "sobject_name": sobject,
         "record_id": record_id,
         "stage": stage,
@@ -320,37 +338,54 @@ def log_error(sobject, record_id, stage, error, record=None):
 # -----------------------------------
 # Core Sync Function
 # -----------------------------------
-def sync_salesforce_object(sobject_name, base_query):
-    print(f"\n🚀 Syncing {sobject_name}")
+def write_group(sobject_name, coll_name, docs, flag_pool=None):
+    """Upsert one vertical group into Mongo and flag it migrated in Salesforce."""
+    collection = db[coll_name]
+    ensure_sf_id_index(collection)
 
-    last_sync = get_last_sync(sobject_name)
-    base_query_clean = base_query.strip()
-
-    where_keyword = "AND" if "WHERE" in base_query_clean.upper() else "WHERE"
-
-    # --------- FIXED SOQL DATETIME FORMAT ----------
-    if last_sync:
-        sf_time = last_sync.strftime("%Y-%m-%dT%H:%M:%SZ")
-        soql = f"""
-            {base_query_clean}
-            {where_keyword} SystemModstamp > {sf_time}
-            ORDER BY SystemModstamp ASC
-        """
-    else:
-        soql = f"""
-            {base_query_clean}
-            ORDER BY CreatedDate ASC
-        """
+    ops = [
+        UpdateOne({"Id": d["Id"]}, {"$set": d}, upsert=True)
+        for d in docs
+    ]
 
-    print("🔎 Executing SOQL:\n", soql)
+    try:
+        collection.bulk_write(ops, ordered=False)
+
+        record_ids = [d["Id"] for d in docs]
+
+        # ---- PATCH SALESFORCE (parallel chunks of 200) ----
+        patch_migrated_flags(sf, sobject_name, record_ids, error_sink, FLAG_PATCH_WORKERS, executor=flag_pool)
+
+        return len(docs)
+
+    except BulkWriteError as bwe:
+        # Log each record's own write error with a collection reference, not the whole record
+        failed = {docs[err["index"]]["Id"]: err.get("errmsg") for err in bwe.details.get("writeErrors", [])}
+        for rid, errmsg in failed.items():
+            log_error(sobject_name, rid, "Mongo/SF Update", errmsg, {"collection": coll_name})
+
+        record_ids = [d["Id"] for d in docs if d["Id"] not in failed]
+        patch_migrated_flags(sf, sobject_name, record_ids, error_sink, FLAG_PATCH_WORKERS, executor=flag_pool)
+
+        return len(record_ids)
+
+    except Exception as e:
+        for d in docs:
+            log_error(sobject_name, d["Id"], "Mongo/SF Update", e, {"collection": coll_name})
 
-    result = sf.query(soql)
+    return 0
+
+
+def sync_window(sobject_name, base_query, lo, hi, writer, flag_pool):
+    """Sync one (lo, hi] SystemModstamp window of an object on the object's shared writer/flag pools."""
+    soql = window_soql(base_query, lo, hi)
+
+    print("🔎 Executing SOQL:\n", soql)
 
     total_processed = 0
-    newest_modstamp = None
 
-    while True:
-        records = result.get("records", [])
+    # Next pages are fetched in the background while this page is written
+    for records in prefetch_pages(query_pages(sf, soql, SF_EXTRACT_MODE), SYNC_PREFETCH_PAGES):
         if not records:
             break
 
@@ -373,77 +408,45 @@ def sync_salesforce_object(sobject_name, base_query):
             coll_name = f"{sobject_name}_{vertical}"
             grouped[coll_name].append(rec)
 
-        # --------- MONGO INSERT + SF UPDATE ----------
-        for coll_name, docs in grouped.items():
-            collection = db[coll_name]
-            collection.create_index("Id", unique=True)
-
-            ops = [
-                UpdateOne({"Id": d["Id"]}, {"$set": d}, upsert=True)
-                for d in docs
-            ]
-
-            try:
-                collection.bulk_write(ops, ordered=False)
-
-                record_ids = [d["Id"] for d in docs]
-
-                # ---- PATCH SALESFORCE IN CHUNKS OF 200 ----
-                for i in range(0, len(record_ids), 200):
-                    chunk = record_ids[i:i + 200]
-
-                    payload = {
-                        "allOrNone": False,
-                        "records": [
-                            {
-                                "attributes": {"type": sobject_name},
-                                "Id": rid,
-                                "Migrated_to_Mongo__c": True
-                            }
-                            for rid in chunk
-                        ]
-                    }
-
-                    response = sf.restful(
-                        "composite/sobjects",
-                        method="PATCH",
-                        data=payload
-                    )
-
-                    for res in response:
-                        if not res.get("success"):
-                            log_error(
-                                sobject_name,
-                                res.get("id"),
-                                "Salesforce PATCH",
-                                res.get("errors"),
-                                payload
-                            )
-
-                total_processed += len(docs)
-
-            except Exception as e:
-                for d in docs:
-                    log_error(sobject_name, d["Id"], "Mongo/SF Update", e, d)
-
-        # --------- CHECKPOINT UPDATE ----------
-        batch_latest = max(
-            (r.get("SystemModstamp") for r in records if r.get("SystemModstamp")),
-            default=None
+        # --------- MONGO INSERT + SF UPDATE (parallel per vertical) ----------
+        total_processed += sum(
+            writer.map(lambda item: write_group(sobject_name, *item, flag_pool), grouped.items())
         )
 
-        if batch_latest:
-            newest_modstamp = batch_latest
+    return total_processed
 
-        if result.get("done"):
-            break
 
-        result = sf.query_more(result["nextRecordsUrl"], True)
+def sync_salesforce_object(sobject_name, base_query):
+    print(f"\n🚀 Syncing {sobject_name}")
 
-    if newest_modstamp:
-        update_checkpoint(sobject_name, newest_modstamp)
+    last_sync = parse_sf_datetime(get_last_sync(sobject_name))
+
+    # --------- INITIAL LOAD: START JUST BEFORE THE OLDEST RECORD ----------
+    if not last_sync:
+        oldest = first_modstamp(sf, base_query)
+        if not oldest:
+            print(f"✅ {sobject_name}: no records")
+            return 0
+        last_sync = oldest - timedelta(seconds=1)
+
+    # --------- CHECKPOINTED SYSTEMMODSTAMP WINDOWS ----------
+    # One writer and one flag pool per object, shared by all its windows, so
+    # threads per object stay at windows + writers + flag PATCHes
+    with ThreadPoolExecutor(max_workers=SYNC_WRITE_WORKERS) as writer, \
+            ThreadPoolExecutor(max_workers=FLAG_PATCH_WORKERS) as flag_pool:
+        total_processed = run_windowed_sync(
+            lambda lo, hi: sync_window(sobject_name, base_query, lo, hi, writer, flag_pool),
+            sobject_name,
+            last_sync,
+            datetime.now(timezone.utc),
+            checkpoint_coll,
+            lambda timestamp: update_checkpoint(sobject_name, timestamp),
+            SYNC_WINDOW_DAYS,
+            SYNC_WINDOW_WORKERS
+        )
 
     print(f"✅ {sobject_name}: {total_processed} records migrated")
+    return total_processed
 
 
 
@@ -451,10 +454,20 @@ def sync_salesforce_object(sobject_name, base_query):
 # Main Execution
 # -----------------------------------
 if __name__ == "__main__":
-    for obj, query in OBJECT_QUERIES.items():
-        try:
-            sync_salesforce_object(obj, query)
-        except Exception as e:
-            log_error(obj, None, "Main Loop", e)
+    sf = BudgetedSalesforce(sf, ApiCallBudget(SF_API_CALL_BUDGET))
+    ensure_all_indexes(db, OBJECT_QUERIES)
+
+    summary = run_object_syncs(
+        sync_salesforce_object,
+        OBJECT_QUERIES,
+        SYNC_MAX_OBJECTS,
+        size_fn=lambda obj, query: count_records(sf, query)
+    )
+
+    for row in summary:
+        if row["error"]:
+            log_error(row["object"], None, "Main Loop", row["error"])
+
+    error_sink.close()
 
     print("\n🎉 All Salesforce objects migrated successfully!")
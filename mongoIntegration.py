@@ -1,9 +1,15 @@
 import os
-from datetime import datetime, timezone
+from datetime import datetime, timedelta, timezone
 from pymongo import MongoClient
 from simple_salesforce import Salesforce
 from dotenv import load_dotenv
 from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from syncHelpers import (
+    bulk_upsert_group, patch_migrated_flags, ensure_sf_id_index, ensure_all_indexes,
+    query_pages, prefetch_pages, ApiCallBudget, BudgetedSalesforce, count_records, run_object_syncs,
+    parse_sf_datetime, first_modstamp, window_soql, run_windowed_sync, BufferedWriter
+)
 
 # -----------------------------------
 # Load Environment Variables
@@ -15,6 +21,17 @@ SF_USERNAME = os.getenv("SF_USERNAME")
 SF_PASSWORD = os.getenv("SF_PASSWORD")
 SF_SECURITY_TOKEN = os.getenv("SF_SECURITY_TOKEN")
 SF_DOMAIN = os.getenv("SF_DOMAIN", "login")
+MONGO_BULK_CHUNK_SIZE = int(os.getenv("MONGO_BULK_CHUNK_SIZE", 1000))
+SF_EXTRACT_MODE = os.getenv("SF_EXTRACT_MODE", "rest")  # rest | bulk (Bulk API 2.0)
+SYNC_PREFETCH_PAGES = int(os.getenv("SYNC_PREFETCH_PAGES", 2))
+SYNC_WRITE_WORKERS = int(os.getenv("SYNC_WRITE_WORKERS", 4))
+FLAG_PATCH_WORKERS = int(os.getenv("FLAG_PATCH_WORKERS", 4))
+SF_API_CALL_BUDGET = int(os.getenv("SF_API_CALL_BUDGET", 0))  # 0 = unlimited
+SYNC_MAX_OBJECTS = int(os.getenv("SYNC_MAX_OBJECTS", 3))
+SYNC_WINDOW_DAYS = int(os.getenv("SYNC_WINDOW_DAYS", 30))
+SYNC_WINDOW_WORKERS = int(os.getenv("SYNC_WINDOW_WORKERS", 4))
+SYNC_ERROR_BATCH_SIZE = int(os.getenv("SYNC_ERROR_BATCH_SIZE", 500))
+SYNC_ERROR_FLUSH_SECONDS = int(os.getenv("SYNC_ERROR_FLUSH_SECONDS", 5))
 
 # -----------------------------------
 # Connect to Salesforce
@@ -36,6 +53,7 @@ print(f"✅ Connected to MongoDB DB: {db.name}")
 
 checkpoint_coll = db["_sync_metadata"]
 error_coll = db["_sync_errors"]
+error_sink = BufferedWriter(error_coll, SYNC_ERROR_BATCH_SIZE, SYNC_ERROR_FLUSH_SECONDS)
 
 # -----------------------------------
 # Queries
@@ -304,7 +322,7 @@ def update_checkpoint(sobject_name, timestamp):
 
 def log_error(sobject, record_id, stage, error, record=None):
     print(f"❌ ERROR [{stage}] → {record_id} → {error}")
-    error_coll.insert_one({
+    error_sink.insert_one({
         "sobject_name": sobject,
         "record_id": record_id,
         "stage": stage,
@@ -317,30 +335,43 @@ def log_error(sobject, record_id, stage, error, record=None):
 # -----------------------------------
 # Core Sync
 # -----------------------------------
-def sync_salesforce_object(sobject_name, base_query):
-    print(f"\n🚀 START SYNC → {sobject_name}")
+def write_group(sobject_name, coll_name, docs, flag_pool=None):
+    """Upsert one vertical group into Mongo and flag it migrated in Salesforce."""
+    collection = db[coll_name]
+    print(f"DEBUG: Processing Mongo collection → {coll_name}")
+
+    ensure_sf_id_index(collection)
+
+    # 🚀 Bulk upsert: one $in lookup + chunked unordered bulk_write
+    write_result = bulk_upsert_group(collection, docs, MONGO_BULK_CHUNK_SIZE)
+    sf_ids_to_update = write_result["written_ids"]
+
+    print(f"DEBUG: Skipped already migrated → {len(write_result['skipped_ids'])}")
+
+    for sf_id, err in write_result["failed"]:
+        log_error(sobject_name, sf_id, "Mongo Bulk Write", err)
+
+    print(f"DEBUG: Salesforce IDs to update → {len(sf_ids_to_update)}")
+
+    # ----------------------------
+    # Salesforce PATCH
+    # ----------------------------
+    patch_migrated_flags(sf, sobject_name, sf_ids_to_update, error_sink, FLAG_PATCH_WORKERS, executor=flag_pool)
+
+    return len(sf_ids_to_update)
 
-    last_sync = get_last_sync(sobject_name)
-    base_query_clean = base_query.strip()
-    where_keyword = "AND" if "WHERE" in base_query_clean.upper() else "WHERE"
 
-    if last_sync:
-        sf_time = last_sync.strftime("%Y-%m-%dT%H:%M:%SZ")
-        soql = f"{base_query_clean} {where_keyword} SystemModstamp > {sf_time} ORDER BY SystemModstamp ASC"
-    else:
-        soql = f"{base_query_clean} ORDER BY CreatedDate ASC"
+def sync_window(sobject_name, base_query, lo, hi, writer, flag_pool):
+    """Sync one (lo, hi] SystemModstamp window of an object on the object's shared writer/flag pools."""
+    soql = window_soql(base_query, lo, hi)
 
     print("DEBUG: SOQL →")
     print(soql)
 
-    result = sf.query(soql)
-    print(f"DEBUG: Initial query result keys → {result.keys()}")
-
     total_processed = 0
-    newest_modstamp = None
 
-    while True:
-        records = result.get("records", [])
+    # Next pages are fetched in the background while this page is written
+    for records in prefetch_pages(query_pages(sf, soql, SF_EXTRACT_MODE), SYNC_PREFETCH_PAGES):
         print(f"DEBUG: Records fetched in batch → {len(records)}")
 
         if not records:
@@ -366,133 +397,65 @@ def sync_salesforce_object(sobject_name, base_query):
         print(f"DEBUG: Grouped collections → {list(grouped.keys())}")
 
         # ----------------------------
-        # Mongo Insert
+        # Mongo Insert + Salesforce PATCH (parallel per vertical)
         # ----------------------------
-        for coll_name, docs in grouped.items():
-            collection = db[coll_name]
-            print(f"DEBUG: Processing Mongo collection → {coll_name}")
-
-            # 🔍 Check existing indexes
-            existing_indexes = collection.index_information()
-            print(f"DEBUG: Existing indexes → {existing_indexes.keys()}")
-
-            id_index_exists = False
-
-            for idx_name, idx_info in existing_indexes.items():
-                if idx_info.get("key") == [("Id", 1)]:
-                    id_index_exists = True
-                    print(f"DEBUG: Found existing Id index → {idx_name}")
-                    break
-
-            # ➕ Create index ONLY if missing
-            if not id_index_exists:
-                print(f"DEBUG: Creating unique Salesforce Id index on {collection.name}")
-                collection.create_index(
-                    [("Id", 1)],
-                    unique=True,
-                    name="sf_id_unique_idx"
-                )
-            else:
-                print(f"DEBUG: Salesforce Id index already exists on {collection.name}")
-
-            # 🚀 Proceed with upsert logic
-            sf_ids_to_update = []
-            
-            for rec in docs:
-                sf_id = rec["Id"]
-                print(f"DEBUG: Processing SF record → {sf_id}")
-
-                existing = collection.find_one({"_id": sf_id})
-                if existing:
-                    print(f"DEBUG: Record already exists in Mongo → {sf_id}")
-                    if existing.get("Migrated_to_Mongo__c"):
-                        print("DEBUG: Skipping already migrated record")
-                        continue
-
-                rec["_id"] = sf_id
-                rec["Migrated_to_Mongo__c"] = True
-                rec["Migrated_On"] = datetime.utcnow()
-
-                collection.update_one(
-                    {"_id": sf_id},
-                    {"$set": rec},
-                    upsert=True
-                )
-
-                print(f"DEBUG: Upserted into Mongo → {sf_id}")
-                sf_ids_to_update.append(sf_id)
-
-            print(f"DEBUG: Salesforce IDs to update → {sf_ids_to_update}")
-
-            # ----------------------------
-            # Salesforce PATCH
-            # ----------------------------
-            for i in range(0, len(sf_ids_to_update), 200):
-                chunk = sf_ids_to_update[i:i + 200]
-                print(f"DEBUG: Salesforce PATCH chunk → {chunk}")
-
-                payload = {
-                    "allOrNone": False,
-                    "records": [
-                        {"attributes": {"type": sobject_name}, "Id": rid, "Migrated_to_Mongo__c": True}
-                        for rid in chunk
-                    ]
-                }
-
-                print("DEBUG: PATCH payload →")
-                print(payload)
-
-                response = sf.restful(
-                    "composite/sobjects",
-                    method="PATCH",
-                    data=payload
-                )
-
-                print("DEBUG: Salesforce PATCH response →")
-                print(response)
-
-                for res in response:
-                    if not res.get("success"):
-                        log_error(
-                            sobject_name,
-                            res.get("id"),
-                            "Salesforce PATCH",
-                            res.get("errors"),
-                            payload
-                        )
-
-            total_processed += len(sf_ids_to_update)
-
-        batch_latest = max(
-            (r.get("SystemModstamp") for r in records if r.get("SystemModstamp")),
-            default=None
+        total_processed += sum(
+            writer.map(lambda item: write_group(sobject_name, *item, flag_pool), grouped.items())
         )
 
-        print(f"DEBUG: Batch latest SystemModstamp → {batch_latest}")
-
-        if batch_latest:
-            newest_modstamp = batch_latest
+    return total_processed
 
-        if result.get("done"):
-            print("DEBUG: Salesforce pagination done")
-            break
 
-        result = sf.query_more(result["nextRecordsUrl"], True)
+def sync_salesforce_object(sobject_name, base_query):
+    print(f"\n🚀 START SYNC → {sobject_name}")
 
-    if newest_modstamp:
-        update_checkpoint(sobject_name, newest_modstamp)
+    last_sync = parse_sf_datetime(get_last_sync(sobject_name))
+
+    if not last_sync:
+        # Initial load: start just before the oldest record so it falls inside the first window
+        oldest = first_modstamp(sf, base_query)
+        if not oldest:
+            print(f"DEBUG: No records in {sobject_name}")
+            return 0
+        last_sync = oldest - timedelta(seconds=1)
+
+    # One writer and one flag pool per object, shared by all its windows, so
+    # threads per object stay at windows + writers + flag PATCHes
+    with ThreadPoolExecutor(max_workers=SYNC_WRITE_WORKERS) as writer, \
+            ThreadPoolExecutor(max_workers=FLAG_PATCH_WORKERS) as flag_pool:
+        total_processed = run_windowed_sync(
+            lambda lo, hi: sync_window(sobject_name, base_query, lo, hi, writer, flag_pool),
+            sobject_name,
+            last_sync,
+            datetime.now(timezone.utc),
+            checkpoint_coll,
+            lambda timestamp: update_checkpoint(sobject_name, timestamp),
+            SYNC_WINDOW_DAYS,
+            SYNC_WINDOW_WORKERS
+        )
 
     print(f"✅ COMPLETED {sobject_name} → {total_processed} records migrated")
+    return total_processed
 
 
 # -----------------------------------
 # Main
 # -----------------------------------
 if __name__ == "__main__":
-    for obj, query in OBJECT_QUERIES.items():
-        try:
-            sync_salesforce_object(obj, query)
-        except Exception as e:
-            log_error(obj, None, "Main Loop", e)
+    sf = BudgetedSalesforce(sf, ApiCallBudget(SF_API_CALL_BUDGET))
+    ensure_all_indexes(db, OBJECT_QUERIES)
+
+    summary = run_object_syncs(
+        sync_salesforce_object,
+        OBJECT_QUERIES,
+        SYNC_MAX_OBJECTS,
+        size_fn=lambda obj, query: count_records(sf, query)
+    )
+
+    for row in summary:
+        if row["error"]:
+            log_error(row["object"], None, "Main Loop", row["error"])
+
+    error_sink.close()
 
     print("\n🎉 All Salesforce objects migrated successfully!")
@@ -1,12 +1,9 @@
 import os
-import mimetypes
-import requests
-import json
-import hashlib
 from datetime import datetime
 from simple_salesforce import Salesforce
 from dotenv import load_dotenv
 from pymongo import MongoClient
+from dmsHelpers import spool_version_data, upload_multipart, HttpTransport, RetryPolicy
 
 # ================= ENV =================
 load_dotenv()
@@ -23,6 +20,12 @@ MONGO_URI   = os.getenv("MONGO_URI")
 
 DOWNLOAD_DIR = "./downloads"
 MAX_SIZE = 6 * 1024 * 1024  # 6 MB
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DMS_DOWNLOAD_CHUNK_SIZE", 1024 * 1024))  # bytes per read while streaming
+SPOOL_MAX_MEMORY = int(os.getenv("DMS_SPOOL_MAX_MEMORY", 16 * 1024 * 1024))  # above this a file spills to a temp file
+DMS_TIMEOUT_RETRIES = int(os.getenv("DMS_TIMEOUT_RETRIES", 2))  # connect/read timeouts
+DMS_ERROR_RETRIES = int(os.getenv("DMS_ERROR_RETRIES", 4))  # 429 and 5xx responses
+transport = HttpTransport()  # one keep-alive session per host, reused for every file
+retry_policy = RetryPolicy(DMS_TIMEOUT_RETRIES, DMS_ERROR_RETRIES)
 
 
 # ================= SALESFORCE LOGIN =================
@@ -38,14 +41,6 @@ def sf_login():
     return sf
 
 
-# ================= SHA1 CHECKSUM =================
-
-def generate_sha1(file_bytes):
-    sha1 = hashlib.sha1()
-    sha1.update(file_bytes)
-    return sha1.hexdigest()
-
-
 # ================= MONGO SETUP =================
 
 mongo_client = MongoClient(MONGO_URI)
@@ -90,27 +85,18 @@ def main():
             file_extension = ext.lower()
 
             # ================= DOWNLOAD FILE =================
-            download_url = f"{sf.base_url}sobjects/ContentVersion/{cv_id}/VersionData"
-
-            sf_resp = requests.get(
-                download_url,
-                headers={"Authorization": f"Bearer {sf.session_id}"},
-                timeout=300
+            # Streamed and hashed into RAM up to SPOOL_MAX_MEMORY, then a temp file
+            spool, size, checksum = spool_version_data(
+                sf, cv_id, SPOOL_MAX_MEMORY, DOWNLOAD_CHUNK_SIZE, timeout=300, session=transport
             )
-            sf_resp.raise_for_status()
-
-            file_bytes = sf_resp.content
 
-            print(f"Downloaded → {filename} ({len(file_bytes)} bytes)")
+            print(f"Downloaded → {filename} ({size} bytes)")
 
             # ================= FORMAT DATE (DD/MM/YYYY) =================
             sf_date = r["CreatedDate"]
             parsed_date = datetime.strptime(sf_date[:10], "%Y-%m-%d")
             formatted_date = parsed_date.strftime("%d/%m/%Y")
 
-            # ================= CHECKSUM =================
-            checksum = generate_sha1(file_bytes)
-
             # ================= BUILD METADATA =================
             metadata = {
                 "vertical": "VF_Gallop",
@@ -119,7 +105,7 @@ def main():
                 "status": "1",
                 "stage": "FI",
                 "sourceSys": "Gallop",
-                "size": str(len(file_bytes)),
+                "size": str(size),
                 "module": "Notice Letters",
                 "latLong": "242-12344",
                 "keyValue": [title],
@@ -139,30 +125,28 @@ def main():
                 "appId": None
             }
 
-            metadata_json = json.dumps(metadata)
-
             # ================= MULTIPART UPLOAD =================
-            files = {
-                "data": (None, metadata_json, "application/json"),
-                "image": (
-                    filename,
-                    file_bytes,
-                    mimetypes.guess_type(filename)[0] or "application/octet-stream"
-                )
-            }
-
             headers = {
                 "Authorization": DMS_AUTH
             }
 
             print(f"Uploading → {filename}")
 
-            dms_resp = requests.post(
-                DMS_URL,
-                headers=headers,
-                files=files,
-                timeout=300
-            )
+            # The spooled bytes become the multipart body as-is and are rewound for every retry
+            with spool:
+                dms_resp, attempts, retry_seconds = retry_policy.call(
+                    lambda: upload_multipart(
+                        DMS_URL,
+                        headers,
+                        metadata,
+                        filename,
+                        spool,
+                        size,
+                        timeout=300,
+                        session=transport
+                    ),
+                    rewind=spool
+                )
 
             print("STATUS:", dms_resp.status_code)
             print("BODY:", dms_resp.text)
@@ -174,7 +158,9 @@ def main():
                     "contentDocumentId": cv_id,
                     "fileName": filename,
                     "status": "Success",
-                    "dmsResponse": dms_resp.text
+                    "dmsResponse": dms_resp.text,
+                    "uploadAttempts": attempts,
+                    "retryLatencySec": retry_seconds
                 })
 
             else:
@@ -183,7 +169,9 @@ def main():
                     "contentDocumentId": cv_id,
                     "fileName": filename,
                     "status": "Failed",
-                    "dmsResponse": dms_resp.text
+                    "dmsResponse": dms_resp.text,
+                    "uploadAttempts": attempts,
+                    "retryLatencySec": retry_seconds
                 })
 
             print("-" * 60)
@@ -199,6 +187,7 @@ def main():
                 "dmsResponse": str(e)
             })
 
+    print("🌐 HTTP pools:", transport.stats())
     print("\n✔ Processing Completed")
 
 
@@ -1,13 +1,14 @@
 import os
 import json
-import hashlib
-import mimetypes
-import requests
 from datetime import datetime, timezone
 
 from dotenv import load_dotenv
 from simple_salesforce import Salesforce
 from pymongo import MongoClient, ASCENDING
+from dmsHelpers import (
+    spool_version_data, upload_multipart, fetch_document_links, ParentCache, load_unchanged_ids,
+    HttpTransport, RetryPolicy, RetryExhausted, dedupe_policy, ensure_checksum_index, find_uploaded_blob, resolve_duplicate
+)
 
 # ---------------- LOAD ENV ----------------
 
@@ -25,11 +26,21 @@ DMS_AUTH = os.getenv("DMS_AUTH_HEADER")
 
 MONGO_URI = os.getenv("MONGO_CONNECTION_STRING")
 
-DOWNLOAD_DIR = "large_files"
 MAX_SIZE = 6 * 1024 * 1024  # 6 MB
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DMS_DOWNLOAD_CHUNK_SIZE", 1024 * 1024))  # bytes per read while streaming
+SPOOL_MAX_MEMORY = int(os.getenv("DMS_SPOOL_MAX_MEMORY", 16 * 1024 * 1024))  # above this a file spills to a temp file
+PARENT_CACHE_SIZE = int(os.getenv("DMS_PARENT_CACHE_SIZE", 10000))  # parent records kept for Vertical/Agreement lookups
+PARENT_CACHE_TTL = int(os.getenv("DMS_PARENT_CACHE_TTL", 900))  # seconds before a cached parent is re-queried
+DMS_REGISTER_URL = os.getenv("DMS_REGISTER_ENDPOINT")
+DEDUPE_POLICY = dedupe_policy(os.getenv("DMS_DEDUPE_POLICY", "off"), DMS_REGISTER_URL)  # off / reference / register
+DMS_TIMEOUT_RETRIES = int(os.getenv("DMS_TIMEOUT_RETRIES", 2))  # connect/read timeouts
+DMS_ERROR_RETRIES = int(os.getenv("DMS_ERROR_RETRIES", 4))  # 429 and 5xx responses
 
-if not os.path.exists(DOWNLOAD_DIR):
-    os.makedirs(DOWNLOAD_DIR)
+# ---------------- PARENT CACHE ----------------
+
+parent_cache = ParentCache(max_size=PARENT_CACHE_SIZE, ttl=PARENT_CACHE_TTL)
+transport = HttpTransport()  # one keep-alive session per host, reused for every file
+retry_policy = RetryPolicy(DMS_TIMEOUT_RETRIES, DMS_ERROR_RETRIES)
 
 # ---------------- DMS WRAPPER ----------------
 
@@ -103,22 +114,11 @@ def mongo_connect():
         [("ContentDocumentId__c", ASCENDING)],
         unique=True
     )
+    ensure_checksum_index(collection)
 
     print("✅ MongoDB Connected")
     return collection
 
-# ---------------- SHA1 ----------------
-
-def generate_sha1(file_path):
-
-    sha1 = hashlib.sha1()
-
-    with open(file_path, "rb") as f:
-        while chunk := f.read(8192):
-            sha1.update(chunk)
-
-    return sha1.hexdigest()
-
 # ---------------- HELPERS ----------------
 
 def build_filename(title, ext):
@@ -128,118 +128,42 @@ def build_filename(title, ext):
         return title
     return f"{title}.{ext}"
 
-# ---------------- SALESFORCE HELPERS ----------------
-
-def get_linked_entity(sf, doc_id):
-
-    query = f"""
-    SELECT LinkedEntityId, LinkedEntity.Type
-    FROM ContentDocumentLink
-    WHERE ContentDocumentId = '{doc_id}'
-    LIMIT 1
-    """
-
-    res = sf.query(query)
-
-    if res["records"]:
-        rec = res["records"][0]
-        return rec["LinkedEntityId"], rec["LinkedEntity"]["Type"]
-
-    return None, None
-
-
-def get_vertical(sf, record_id, obj):
-
-    if not record_id or not obj:
-        return None
-
-    try:
-        query = f"""
-        SELECT Vertical__c
-        FROM {obj}
-        WHERE Id = '{record_id}'
-        LIMIT 1
-        """
-        res = sf.query(query)
-
-        if res["records"]:
-            return res["records"][0].get("Vertical__c")
-
-    except Exception as e:
-        print("❌ Vertical fetch failed:", str(e))
-
-    return None
-
-
-def get_agreement_number(sf, record_id, obj):
-
-    if not record_id or not obj:
-        return "UNKNOWN"
-
-    try:
-        query = f"""
-        SELECT Agreement_No__c
-        FROM {obj}
-        WHERE Id = '{record_id}'
-        LIMIT 1
-        """
-        res = sf.query(query)
-
-        if res["records"]:
-            return res["records"][0].get("Agreement_No__c") or "UNKNOWN"
-
-    except Exception as e:
-        print("❌ Agreement fetch failed:", str(e))
-
-    return "UNKNOWN"
-
 # ---------------- DOWNLOAD ----------------
 
 def download_file(sf, cv_id, filename):
 
-    url = f"{sf.base_url}sobjects/ContentVersion/{cv_id}/VersionData"
-
-    headers = {
-        "Authorization": f"Bearer {sf.session_id}"
-    }
-
-    path = os.path.join(DOWNLOAD_DIR, filename)
-
-    with requests.get(url, headers=headers, stream=True) as r:
-        r.raise_for_status()
-        with open(path, "wb") as f:
-            for chunk in r.iter_content(8192):
-                f.write(chunk)
+    # SHA-1 and size are taken while the chunks arrive; RAM up to SPOOL_MAX_MEMORY, then a temp file
+    result = spool_version_data(sf, cv_id, SPOOL_MAX_MEMORY, DOWNLOAD_CHUNK_SIZE, session=transport)
 
     print("📥 Downloaded:", filename)
-    return path
+    return result
 
 # ---------------- DMS UPLOAD ----------------
 
-def upload_to_dms(file_path, metadata):
-
-    filename = os.path.basename(file_path)
-
-    mime = mimetypes.guess_type(filename)[0] or "application/octet-stream"
+def upload_to_dms(spool, size, filename, metadata):
 
     print("\n🚀 Uploading:", filename)
     print("📦 Payload:", json.dumps(metadata, indent=2))
 
-    files = {
-        "data": (None, json.dumps(metadata), "application/json"),
-        "image": (filename, open(file_path, "rb"), mime)
-    }
-
     headers = {
         "Authorization": DMS_AUTH
     }
 
-    response = requests.post(
-        DMS_URL,
-        headers=headers,
-        files=files,
-        timeout=600
-    )
+    # The spooled bytes become the multipart body as-is and are rewound for every retry
+    with spool:
+        response, attempts, retry_seconds = retry_policy.call(
+            lambda: upload_multipart(
+                DMS_URL,
+                headers,
+                metadata,
+                filename,
+                spool,
+                size,
+                timeout=600,
+                session=transport
+            ),
+            rewind=spool
+        )
 
     print("🔹 Status:", response.status_code)
 
@@ -248,7 +172,7 @@ def upload_to_dms(file_path, metadata):
     except:
         print("🔹 Raw:", response.text)
 
-    return response
+    return response, attempts, retry_seconds
 
 # ---------------- MAIN ----------------
 
@@ -261,7 +185,7 @@ def main():
     end = input("End Date (YYYY-MM-DD): ")
 
     query = f"""
-    SELECT Id, Title, FileExtension, ContentSize,
+    SELECT Id, Title, FileExtension, ContentSize, Checksum,
            ContentDocumentId, CreatedDate,
            CreatedBy.Name
     FROM ContentVersion
@@ -276,6 +200,24 @@ def main():
 
     print("📊 Files Found:", len(records))
 
+    # SuccessToDMS files whose version, Checksum and size still match are skipped without a download
+    done = load_unchanged_ids(
+        mongo,
+        {r["ContentDocumentId"]: (r["Id"], r.get("Checksum"), r["ContentSize"]) for r in records},
+        done_filter={"Migrate_Status__c": "SuccessToDMS"}
+    )
+    records = [r for r in records if r["ContentDocumentId"] not in done]
+
+    # ---------------- METADATA PREFETCH ----------------
+    # Links and parent Vertical/Agreement for every file up front, in chunked IN queries
+    links = fetch_document_links(sf, {r["ContentDocumentId"] for r in records})
+
+    parent_ids_by_type = {}
+    for linked_id, obj in links.values():
+        parent_ids_by_type.setdefault(obj, set()).add(linked_id)
+
+    parent_cache.prefetch(sf, parent_ids_by_type)
+
     for r in records:
 
         try:
@@ -289,52 +231,84 @@ def main():
 
             filename = build_filename(title, ext)
 
-            local_path = download_file(sf, cv_id, filename)
+            # -------- DEDUPE --------
+            # Same bytes already in DMS: Salesforce's Checksum matches before download, our SHA-1 after
+            original = None
+            if DEDUPE_POLICY != "off":
+                original = find_uploaded_blob(mongo, r["ContentSize"], sf_checksum=r.get("Checksum"))
 
-            size = os.path.getsize(local_path)
+            if original:
+                spool, size, checksum = None, r["ContentSize"], original["Checksum__c"]
+            else:
+                spool, size, checksum = download_file(sf, cv_id, filename)
 
-            checksum = generate_sha1(local_path)
+                if DEDUPE_POLICY != "off":
+                    original = find_uploaded_blob(mongo, size, checksum=checksum)
 
-            linked_id, obj = get_linked_entity(sf, doc_id)
+            linked_id, obj = links.get(doc_id, (None, None))
 
-            vertical = get_vertical(sf, linked_id, obj)
+            parent, cache_hit = parent_cache.lookup(sf, obj, linked_id)
 
-            agreement_no = get_agreement_number(sf, linked_id, obj)
+            vertical = parent.get("Vertical__c")
+
+            agreement_no = parent.get("Agreement_No__c") or "UNKNOWN"
 
             metadata = DMSRequestWrapper.create_upload_request(
                 r, doc_id, size, checksum, vertical, agreement_no, ext, filename
             )
 
-            res = upload_to_dms(local_path, metadata)
-
-            status = "SuccessToDMS" if res.status_code in [200, 201] else "FailedToDMS"
+            dedupe = {}
+            if original:
+                if spool:
+                    spool.close()
+
+                attempts, retry_seconds = 0, 0
+                status, response_text, dedupe = resolve_duplicate(
+                    original, DEDUPE_POLICY, DMS_REGISTER_URL, {"Authorization": DMS_AUTH}, metadata, session=transport
+                )
+                print(f"♻️ Duplicate of {dedupe['Duplicate_Of__c']} ({DEDUPE_POLICY})")
+            else:
+                try:
+                    res, attempts, retry_seconds = upload_to_dms(spool, size, filename, metadata)
+
+                    status = "SuccessToDMS" if res.status_code in [200, 201] else "FailedToDMS"
+                    response_text = res.text
+                except RetryExhausted as e:
+                    # Still tracked, so an exhausted file is retried like any other failure
+                    print("⚠️ Retries exhausted:", str(e))
+                    status, response_text = "FailedToDMS", str(e)
+                    attempts, retry_seconds = e.attempts, e.retry_seconds
 
             mongo.update_one(
                 {"ContentDocumentId__c": doc_id},
                 {"$set": {
                     "ContentDocumentId__c": doc_id,
                     "Document_Name__c": filename,
+                    "ContentVersionId__c": cv_id,
                     "Vertical__c": vertical,
                     "sObject_Name__c": obj,
                     "sObject_Record_Id__c": linked_id,
-                    "DMS_Response__c": res.text,
+                    "Parent_Cache_Hit__c": cache_hit,
+                    "DMS_Response__c": response_text,
+                    "Upload_Attempts__c": attempts,
+                    "Retry_Latency_Sec__c": retry_seconds,
                     "Migrate_Status__c": status,
                     "Checksum__c": checksum,
+                    "SF_Checksum__c": r.get("Checksum"),
                     "File_Size": size,
-                    "CreatedDate": datetime.now(timezone.utc)
+                    "CreatedDate": datetime.now(timezone.utc),
+                    **dedupe
                 }},
                 upsert=True
             )
 
             print("✅ Mongo Saved | Status:", status)
 
-            if status == "SuccessToDMS":
-                os.remove(local_path)
-                print("🧹 File Deleted")
-
         except Exception as e:
             print("❌ ERROR:", str(e))
 
+    print("📚 Parent cache:", parent_cache.stats())
+    print("🌐 HTTP pools:", transport.stats())
     print("\n🎉 PROCESS COMPLETED")
 
 # ---------------- RUN ----------------
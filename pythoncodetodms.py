@@ -1,12 +1,9 @@
 import os
-import mimetypes
-import requests
-import json
-import hashlib
 from datetime import datetime, timezone
 from simple_salesforce import Salesforce
 from dotenv import load_dotenv
 from pymongo import MongoClient, ASCENDING
+from dmsHelpers import spool_version_data, upload_multipart, fetch_document_links, HttpTransport, RetryPolicy
 
 # ================= ENV =================
 load_dotenv()
@@ -22,6 +19,12 @@ DMS_AUTH    = os.getenv("DMS_AUTH_HEADER")
 MONGO_URI   = os.getenv("MONGO_URI")
 
 MAX_SIZE = 6 * 1024 * 1024  # 6 MB
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DMS_DOWNLOAD_CHUNK_SIZE", 1024 * 1024))  # bytes per read while streaming
+SPOOL_MAX_MEMORY = int(os.getenv("DMS_SPOOL_MAX_MEMORY", 16 * 1024 * 1024))  # above this a file spills to a temp file
+DMS_TIMEOUT_RETRIES = int(os.getenv("DMS_TIMEOUT_RETRIES", 2))  # connect/read timeouts
+DMS_ERROR_RETRIES = int(os.getenv("DMS_ERROR_RETRIES", 4))  # 429 and 5xx responses
+transport = HttpTransport()  # one keep-alive session per host, reused for every file
+retry_policy = RetryPolicy(DMS_TIMEOUT_RETRIES, DMS_ERROR_RETRIES)
 
 
 # ================= SALESFORCE LOGIN =================
@@ -36,13 +39,6 @@ def sf_login():
     return sf
 
 
-# ================= SHA1 CHECKSUM =================
-def generate_sha1(file_bytes):
-    sha1 = hashlib.sha1()
-    sha1.update(file_bytes)
-    return sha1.hexdigest()
-
-
 # ================= MONGO SETUP =================
 mongo_client = MongoClient(MONGO_URI)
 db = mongo_client["salesforce_dms"]
@@ -78,6 +74,8 @@ def main():
     records = sf.query_all(query)["records"]
     print(f"\nFound {len(records)} eligible files\n")
 
+    links = fetch_document_links(sf, {r["ContentDocumentId"] for r in records})
+
     for r in records:
 
         try:
@@ -88,21 +86,7 @@ def main():
             owner_name = r["Owner"]["Name"]
 
             # ================= GET LINKED ENTITY =================
-            cdl_query = f"""
-            SELECT LinkedEntityId, LinkedEntity.Type
-            FROM ContentDocumentLink
-            WHERE ContentDocumentId = '{content_document_id}'
-            LIMIT 1
-            """
-
-            cdl_result = sf.query(cdl_query)
-
-            if cdl_result["records"]:
-                linked_entity_id = cdl_result["records"][0]["LinkedEntityId"]
-                sobject_type = cdl_result["records"][0]["LinkedEntity"]["Type"]
-            else:
-                linked_entity_id = None
-                sobject_type = None
+            linked_entity_id, sobject_type = links.get(content_document_id, (None, None))
 
             # ================= FILE NAME =================
             if ext and not title.lower().endswith(f".{ext.lower()}"):
@@ -111,19 +95,11 @@ def main():
                 filename = title
 
             # ================= DOWNLOAD FILE =================
-            download_url = f"{sf.base_url}sobjects/ContentVersion/{cv_id}/VersionData"
-
-            sf_resp = requests.get(
-                download_url,
-                headers={"Authorization": f"Bearer {sf.session_id}"},
-                timeout=300
+            # Streamed and hashed into RAM up to SPOOL_MAX_MEMORY, then a temp file
+            spool, size, checksum = spool_version_data(
+                sf, cv_id, SPOOL_MAX_MEMORY, DOWNLOAD_CHUNK_SIZE, timeout=300, session=transport
             )
-            sf_resp.raise_for_status()
-
-            file_bytes = sf_resp.content
-            checksum = generate_sha1(file_bytes)
-
-            print(f"Downloaded → {filename} ({len(file_bytes)} bytes)")
+            print(f"Downloaded → {filename} ({size} bytes)")
 
             # ================= DATE FORMAT =================
             sf_date = r["CreatedDate"]
@@ -138,7 +114,7 @@ def main():
                 "status": "1",
                 "stage": "FI",
                 "sourceSys": "Gallop",
-                "size": str(len(file_bytes)),
+                "size": str(size),
                 "module": "Notice Letters",
                 "latLong": "242-12344",
                 "keyValue": [title],
@@ -159,27 +135,27 @@ def main():
             }
 
             # ================= MULTIPART UPLOAD =================
-            files = {
-                "data": (None, json.dumps(metadata), "application/json"),
-                "image": (
-                    filename,
-                    file_bytes,
-                    mimetypes.guess_type(filename)[0] or "application/octet-stream"
-                )
-            }
-
             headers = {
                 "Authorization": DMS_AUTH
             }
 
             print(f"Uploading → {filename}")
 
-            dms_resp = requests.post(
-                DMS_URL,
-                headers=headers,
-                files=files,
-                timeout=300
-            )
+            # The spooled bytes become the multipart body as-is and are rewound for every retry
+            with spool:
+                dms_resp, attempts, retry_seconds = retry_policy.call(
+                    lambda: upload_multipart(
+                        DMS_URL,
+                        headers,
+                        metadata,
+                        filename,
+                        spool,
+                        size,
+                        timeout=300,
+                        session=transport
+                    ),
+                    rewind=spool
+                )
 
             print("STATUS:", dms_resp.status_code)
             print("BODY:", dms_resp.text)
@@ -203,6 +179,8 @@ def main():
                     "Vertical__c": "VF_Gallop",
                     "Content_File_Owner__c": owner_name,
                     "Checksum__c": checksum,
+                    "Upload_Attempts__c": attempts,
+                    "Retry_Latency_Sec__c": retry_seconds,
                     "CreatedDate": datetime.now(timezone.utc)
                 }
 
@@ -222,6 +200,8 @@ def main():
                     "Vertical__c": "VF_Gallop",
                     "Content_File_Owner__c": owner_name,
                     "Checksum__c": checksum,
+                    "Upload_Attempts__c": attempts,
+                    "Retry_Latency_Sec__c": retry_seconds,
                     "Error_Message__c": dms_resp.text,
                     "CreatedDate": datetime.now(timezone.utc)
                 }
@@ -255,6 +235,7 @@ def main():
                 upsert=True
             )
 
+    print("🌐 HTTP pools:", transport.stats())
     print("\n✔ Processing Completed")
 
 
@@ -4,10 +4,17 @@ import os
 from datetime import datetime
 from simple_salesforce import Salesforce
 from pymongo import MongoClient
+from pymongo.errors import BulkWriteError
 from dotenv import load_dotenv
+from syncHelpers import query_records, grouped_batches, patch_migrated_flags, bulk_update_flags
 
 load_dotenv()
 
+SF_EXTRACT_MODE = os.getenv("SF_EXTRACT_MODE", "rest")  # rest | bulk (Bulk API 2.0)
+SF_BULK_UPDATE_THRESHOLD = int(os.getenv("SF_BULK_UPDATE_THRESHOLD", 10000))  # use a Bulk API job at/above this
+SYNC_FLUSH_SIZE = int(os.getenv("SYNC_FLUSH_SIZE", 2000))        # records per vertical before a Mongo flush
+SYNC_MAX_BUFFERED = int(os.getenv("SYNC_MAX_BUFFERED", 10000))   # records held across all verticals
+
 # ============================================================
 # Salesforce Login
 # ============================================================
@@ -38,6 +45,42 @@ def get_nested_value(record, field_path):
     return value
 
 
+def sf_update_error(object_name, rid, error):
+    return {
+        "object": object_name,
+        "salesforce_id": rid,
+        "stage": "SALESFORCE_UPDATE",
+        "error": str(error),
+        "timestamp": datetime.utcnow()
+    }
+
+
+# ============================================================
+# Update Salesforce Flag (SAFE)
+# ============================================================
+def flag_migrated(object_name, sf_ids, error_collection):
+    """Set Migrated_to_Mongo__c on sf_ids; returns how many were updated."""
+    if len(sf_ids) >= SF_BULK_UPDATE_THRESHOLD:
+        # Large batch → one Bulk API 2.0 update job
+        try:
+            failures = bulk_update_flags(sf, object_name, sf_ids)
+        except Exception as e:
+            failures = {rid: e for rid in sf_ids}
+
+        if failures:
+            error_collection.insert_many(
+                [sf_update_error(object_name, rid, err) for rid, err in failures.items()],
+                ordered=False
+            )
+
+        return len(sf_ids) - len(failures)
+
+    # composite/sobjects collections → 200 records per call
+    return patch_migrated_flags(
+        sf, object_name, sf_ids, error_collection, error_doc=sf_update_error
+    )
+
+
 # ============================================================
 # Generic Bulk Push Function (WITH ERROR TRACKING)
 # ============================================================
@@ -47,86 +90,71 @@ def bulk_push(object_name, soql, vertical_field_path):
     print(f"Processing Object: {object_name}")
     print(f"==============================")
 
-    records = sf.query_all(soql)["records"]
-    print(f"Fetched records: {len(records)}")
-
-    if not records:
-        print("No records found. Skipping.")
-        return
-
-    vertical_map = {}
-    sf_ids = []
+    fetched = 0
+    updated = 0
     error_collection = db[f"{object_name}_ERRORS"]
 
     # -----------------------------
-    # Group records by Vertical
+    # Group records by Vertical (streamed)
     # -----------------------------
-    for rec in records:
-        try:
-            vertical = get_nested_value(rec, vertical_field_path) or "Unknown"
-            cleaned = {k: v for k, v in rec.items() if k != "attributes"}
+    def keyed_records():
+        nonlocal fetched
+        for rec in query_records(sf, soql, SF_EXTRACT_MODE):
+            try:
+                vertical = get_nested_value(rec, vertical_field_path) or "Unknown"
+                cleaned = {k: v for k, v in rec.items() if k != "attributes"}
 
-            vertical_map.setdefault(vertical, []).append(cleaned)
-            sf_ids.append(rec["Id"])
+                fetched += 1
+                yield vertical, cleaned
 
-        except Exception as e:
-            error_collection.insert_one({
-                "object": object_name,
-                "salesforce_id": rec.get("Id"),
-                "stage": "GROUPING",
-                "error": str(e),
-                "record": rec,
-                "timestamp": datetime.utcnow()
-            })
+            except Exception as e:
+                error_collection.insert_one({
+                    "object": object_name,
+                    "salesforce_id": rec.get("Id"),
+                    "stage": "GROUPING",
+                    "error": str(e),
+                    "record": rec,
+                    "timestamp": datetime.utcnow()
+                })
 
     # -----------------------------
-    # Insert into MongoDB
+    # Insert into MongoDB (flushed by size), then flag that batch
     # -----------------------------
-    for vertical, rec_list in vertical_map.items():
+    for vertical, rec_list in grouped_batches(keyed_records(), SYNC_FLUSH_SIZE, SYNC_MAX_BUFFERED):
         collection_name = f"{object_name}_{vertical}"
         collection = db[collection_name]
 
         try:
             collection.insert_many(rec_list, ordered=False)
+            inserted = rec_list
             print(f"Inserted {len(rec_list)} records → {collection_name}")
 
         except Exception as e:
+            # Only the records Mongo actually took get flagged in Salesforce
+            failed = set()
+            if isinstance(e, BulkWriteError):
+                failed = {err["index"] for err in e.details.get("writeErrors", [])}
+            inserted = [rec for i, rec in enumerate(rec_list) if i not in failed] if failed else []
+
             error_collection.insert_one({
                 "object": object_name,
                 "vertical": vertical,
                 "stage": "MONGO_INSERT",
                 "error": str(e),
-                "records_count": len(rec_list),
+                "records_count": len(rec_list) - len(inserted),
                 "timestamp": datetime.utcnow()
             })
 
-    # -----------------------------
-    # Update Salesforce Flag (SAFE)
-    # -----------------------------
-    print("Updating Salesforce Migrated_to_Mongo__c flag...")
-
-    chunk_size = 200
-    sf_object = sf.__getattr__(object_name)
+        if inserted:
+            updated += flag_migrated(object_name, [rec["Id"] for rec in inserted], error_collection)
 
-    for i in range(0, len(sf_ids), chunk_size):
-        chunk = sf_ids[i:i + chunk_size]
+    print(f"Fetched records: {fetched}")
 
-        for rid in chunk:
-            try:
-                sf_object.update(rid, {
-                    "Migrated_to_Mongo__c": True
-                })
-            except Exception as e:
-                error_collection.insert_one({
-                    "object": object_name,
-                    "salesforce_id": rid,
-                    "stage": "SALESFORCE_UPDATE",
-                    "error": str(e),
-                    "timestamp": datetime.utcnow()
-                })
-
-        print(f"Updated {len(chunk)} Salesforce records")
+    if not fetched:
+        print("No records found. Skipping.")
+        return
 
+    print(f"Updated {updated} Salesforce records")
     print(f"✅ Migration completed for {object_name}")
 
 
@@ -0,0 +1,814 @@
+import io
+import atexit
+import re
+import csv
+import time
+import queue
+import threading
+from datetime import datetime, timedelta, timezone
+from collections import defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from pymongo import UpdateOne
+from pymongo.errors import BulkWriteError
+
+VERTICALS = ("SME", "LAP", "HL", "OTHER")
+
+_PAGES_DONE = object()
+
+_ensured_indexes = set()
+_index_lock = threading.Lock()
+
+
+# -----------------------------------
+# Index Manager
+# -----------------------------------
+def ensure_sf_id_index(collection):
+    """Ensure the unique Salesforce Id index exists, once per process per collection.
+
+    The _id index is created by MongoDB itself, so only sf_id_unique_idx is checked.
+    """
+    key = collection.full_name
+    if key in _ensured_indexes:
+        return
+
+    with _index_lock:
+        if key in _ensured_indexes:
+            return
+
+        existing_indexes = collection.index_information()
+        id_index_exists = any(
+            idx_info.get("key") == [("Id", 1)] for idx_info in existing_indexes.values()
+        )
+
+        if not id_index_exists:
+            print(f"DEBUG: Creating unique Salesforce Id index on {collection.name}")
+            collection.create_index([("Id", 1)], unique=True, name="sf_id_unique_idx")
+
+        _ensured_indexes.add(key)
+
+
+def ensure_all_indexes(db, object_names, verticals=VERTICALS):
+    """Ensure indexes for every {object}_{vertical} collection up front."""
+    for sobject_name in object_names:
+        for vertical in verticals:
+            ensure_sf_id_index(db[f"{sobject_name}_{vertical}"])
+
+    print(f"✅ Indexes ensured for {len(object_names)} objects × {len(verticals)} verticals")
+
+
+# -----------------------------------
+# Mongo Bulk Write
+# -----------------------------------
+def find_migrated_ids(collection, sf_ids):
+    """Return the subset of sf_ids already flagged Migrated_to_Mongo__c in Mongo."""
+    if not sf_ids:
+        return set()
+
+    cursor = collection.find(
+        {"_id": {"$in": list(sf_ids)}, "Migrated_to_Mongo__c": True},
+        {"_id": 1}
+    )
+    return {doc["_id"] for doc in cursor}
+
+
+def bulk_upsert_group(collection, docs, chunk_size=1000):
+    """Upsert one vertical group with a single $in lookup and chunked unordered bulk_write.
+
+    Returns a dict with the written, skipped and failed Salesforce Ids plus
+    per-chunk upserted/modified/failed counts.
+    """
+    result = {"written_ids": [], "skipped_ids": [], "failed": [], "chunks": []}
+
+    migrated = find_migrated_ids(collection, [rec["Id"] for rec in docs])
+    pending = []
+
+    for rec in docs:
+        sf_id = rec["Id"]
+        if sf_id in migrated:
+            result["skipped_ids"].append(sf_id)
+            continue
+
+        rec["_id"] = sf_id
+        rec["Migrated_to_Mongo__c"] = True
+        rec["Migrated_On"] = datetime.utcnow()
+        pending.append(rec)
+
+    for i in range(0, len(pending), chunk_size):
+        chunk = pending[i:i + chunk_size]
+        ops = [UpdateOne({"_id": rec["_id"]}, {"$set": rec}, upsert=True) for rec in chunk]
+        stats = {"chunk": i // chunk_size + 1, "size": len(chunk), "upserted": 0, "modified": 0, "failed": 0}
+        failed_idx = set()
+
+        try:
+            res = collection.bulk_write(ops, ordered=False)
+            stats["upserted"] = res.upserted_count or 0
+            stats["modified"] = res.modified_count or 0
+
+        except BulkWriteError as bwe:
+            details = bwe.details or {}
+            stats["upserted"] = details.get("nUpserted", 0)
+            stats["modified"] = details.get("nModified", 0)
+
+            for err in details.get("writeErrors", []):
+                failed_idx.add(err["index"])
+                result["failed"].append((chunk[err["index"]]["_id"], err.get("errmsg")))
+
+        except Exception as e:
+            failed_idx = set(range(len(chunk)))
+            result["failed"].extend((rec["_id"], str(e)) for rec in chunk)
+
+        stats["failed"] = len(failed_idx)
+        result["written_ids"].extend(
+            rec["_id"] for idx, rec in enumerate(chunk) if idx not in failed_idx
+        )
+        result["chunks"].append(stats)
+
+        print(
+            f"DEBUG: {collection.name} chunk {stats['chunk']} → "
+            f"upserted={stats['upserted']} modified={stats['modified']} failed={stats['failed']}"
+        )
+
+    return result
+
+
+# -----------------------------------
+# Buffered Error Log
+# -----------------------------------
+class BufferedWriter:
+    """Stand-in for an error collection that batches insert_one/insert_many calls.
+
+    Docs are written with one unordered insert_many when batch_size are waiting,
+    every flush_interval seconds from a background thread, and on close() or
+    interpreter exit. A failed flush is reported, never raised into the sync.
+    """
+
+    def __init__(self, collection, batch_size=500, flush_interval=5):
+        self.collection = collection
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+        self._docs = []
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._closed = threading.Event()
+
+        threading.Thread(target=self._flush_periodically, daemon=True).start()
+        atexit.register(self.close)
+
+    def _flush_periodically(self):
+        while not self._closed.wait(self.flush_interval):
+            self.flush()
+
+    def insert_one(self, doc):
+        self.insert_many([doc])
+
+    def insert_many(self, docs, ordered=False):
+        with self._lock:
+            self._docs.extend(docs)
+            full = len(self._docs) >= self.batch_size
+
+        if full:
+            self.flush()
+
+    def flush(self):
+        # Swapping under _flush_lock keeps batches in the order they were queued
+        with self._flush_lock:
+            with self._lock:
+                docs, self._docs = self._docs, []
+
+            if not docs:
+                return 0
+
+            try:
+                self.collection.insert_many(docs, ordered=False)
+            except BulkWriteError as bwe:
+                print(f"⚠️ {len(bwe.details.get('writeErrors', []))}/{len(docs)} error logs not written to {self.collection.name}")
+            except Exception as e:
+                print(f"⚠️ Failed to write {len(docs)} error logs to {self.collection.name}: {e}")
+
+            return len(docs)
+
+    def close(self):
+        self._closed.set()
+        self.flush()
+
+
+# -----------------------------------
+# Salesforce Flag Writeback
+# -----------------------------------
+def _flag_error_doc(sobject_name, record_id, error):
+    return {
+        "sobject_name": sobject_name,
+        "record_id": record_id,
+        "stage": "Salesforce PATCH",
+        "error": str(error),
+        "record": None,
+        "timestamp": datetime.now(timezone.utc)
+    }
+
+
+def _patch_flag_chunk(sf, sobject_name, chunk, error_coll, retries, error_doc):
+    pending = list(chunk)
+    errors = {}
+
+    for attempt in range(retries + 1):
+        if attempt:
+            time.sleep(attempt)
+            print(f"DEBUG: Retrying {len(pending)} failed {sobject_name} flag updates (attempt {attempt + 1})")
+
+        payload = {
+            "allOrNone": False,
+            "records": [
+                {"attributes": {"type": sobject_name}, "Id": rid, "Migrated_to_Mongo__c": True}
+                for rid in pending
+            ]
+        }
+
+        try:
+            response = sf.restful("composite/sobjects", method="PATCH", data=payload)
+        except Exception as e:
+            errors = {rid: e for rid in pending}
+            continue
+
+        # composite/sobjects answers in request order; failed rows may carry no id
+        errors = {rid: res.get("errors") for rid, res in zip(pending, response) if not res.get("success")}
+        pending = list(errors)
+        if not pending:
+            break
+
+    if errors:
+        error_coll.insert_many(
+            [error_doc(sobject_name, rid, err) for rid, err in errors.items()],
+            ordered=False
+        )
+        print(f"❌ ERROR [Salesforce PATCH] → {len(errors)} {sobject_name} records not flagged")
+
+    return len(chunk) - len(errors)
+
+
+def patch_migrated_flags(sf, sobject_name, record_ids, error_coll, max_workers=4, retries=2, chunk_size=200,
+                         error_doc=_flag_error_doc, executor=None):
+    """Set Migrated_to_Mongo__c on record_ids with concurrent composite/sobjects PATCHes.
+
+    Only the Ids that failed in a response are retried. Whatever still fails is
+    written to error_coll with one insert_many per chunk, shaped by
+    error_doc(sobject_name, record_id, error). Returns the flagged count.
+    Pass a shared executor to bound PATCHes across callers; otherwise a pool of
+    max_workers is used for this call.
+    """
+    chunks = [record_ids[i:i + chunk_size] for i in range(0, len(record_ids), chunk_size)]
+    if not chunks:
+        return 0
+
+    def patch(pool):
+        return sum(pool.map(
+            lambda chunk: _patch_flag_chunk(sf, sobject_name, chunk, error_coll, retries, error_doc),
+            chunks
+        ))
+
+    if executor:
+        flagged = patch(executor)
+    else:
+        with ThreadPoolExecutor(max_workers=max_workers) as pool:
+            flagged = patch(pool)
+
+    print(f"DEBUG: {sobject_name} flags PATCHed → {flagged}/{len(record_ids)} in {len(chunks)} chunks")
+    return flagged
+
+
+def bulk_update_flags(sf, sobject_name, record_ids, poll_interval=5):
+    """Set Migrated_to_Mongo__c through one Bulk API 2.0 update job.
+
+    Returns {record_id: error} for the rows Salesforce rejected.
+    """
+    jobs_url = f"{sf.base_url}jobs/ingest"
+
+    res = _bulk_request(
+        sf, "POST",
+        jobs_url,
+        headers=_bulk_headers(sf),
+        json={"object": sobject_name, "operation": "update", "contentType": "CSV", "lineEnding": "LF"}
+    )
+    job_id = res.json()["id"]
+    print(f"DEBUG: Bulk API update job created → {job_id} ({len(record_ids)} records)")
+
+    body = "Id,Migrated_to_Mongo__c\n" + "".join(f"{rid},true\n" for rid in record_ids)
+    _bulk_request(
+        sf, "PUT",
+        f"{jobs_url}/{job_id}/batches",
+        headers={"Authorization": f"Bearer {sf.session_id}", "Content-Type": "text/csv"},
+        data=body.encode("utf-8")
+    )
+
+    _bulk_request(sf, "PATCH", f"{jobs_url}/{job_id}", headers=_bulk_headers(sf), json={"state": "UploadComplete"})
+
+    while True:
+        res = _bulk_request(sf, "GET", f"{jobs_url}/{job_id}", headers=_bulk_headers(sf))
+        job = res.json()
+
+        if job["state"] == "JobComplete":
+            break
+        if job["state"] in ("Failed", "Aborted"):
+            raise Exception(f"❌ Bulk update job {job_id} {job['state']}: {job.get('errorMessage')}")
+
+        time.sleep(poll_interval)
+
+    print(
+        f"DEBUG: Bulk API update job complete → processed={job.get('numberRecordsProcessed')} "
+        f"failed={job.get('numberRecordsFailed')}"
+    )
+
+    if not int(job.get("numberRecordsFailed") or 0):
+        return {}
+
+    res = _bulk_request(
+        sf, "GET",
+        f"{jobs_url}/{job_id}/failedResults",
+        headers={"Authorization": f"Bearer {sf.session_id}", "Accept": "text/csv"}
+    )
+    res.encoding = "utf-8"
+
+    return {
+        row.get("Id") or row.get("sf__Id"): row.get("sf__Error")
+        for row in csv.DictReader(io.StringIO(res.text))
+    }
+
+# -----------------------------------
+# Salesforce Extraction
+# -----------------------------------
+def rest_query_pages(sf, soql):
+    """Yield record pages from the REST query / query_more cursor."""
+    result = sf.query(soql)
+
+    while True:
+        yield result.get("records", [])
+
+        if result.get("done"):
+            break
+
+        result = sf.query_more(result["nextRecordsUrl"], True)
+
+
+def _bulk_headers(sf):
+    return {
+        "Authorization": f"Bearer {sf.session_id}",
+        "Content-Type": "application/json"
+    }
+
+
+def _bulk_request(sf, method, url, **kwargs):
+    """Bulk API 2.0 call on sf.session, charged to the ApiCallBudget of a BudgetedSalesforce."""
+    if isinstance(sf, BudgetedSalesforce):
+        sf.budget.spend()
+
+    res = sf.session.request(method, url, **kwargs)
+    res.raise_for_status()
+    return res
+
+
+def _csv_value(value):
+    if value == "":
+        return None
+    if value == "true":
+        return True
+    if value == "false":
+        return False
+    return value
+
+
+def _collapse_empty(rec):
+    for key, value in rec.items():
+        if isinstance(value, dict):
+            _collapse_empty(value)
+            if all(v is None for v in value.values()):
+                rec[key] = None
+    return rec
+
+
+# describe() field types the REST API returns as JSON numbers
+_NUMBER_TYPES = {
+    "int": int,
+    "long": int,
+    "double": float,
+    "currency": float,
+    "percent": float
+}
+
+
+def _soql_object(soql):
+    match = re.search(r"\bFROM\s+(\w+)", soql, re.IGNORECASE)
+    return match.group(1) if match else None
+
+
+def bulk_column_types(sf, sobject, columns):
+    """Map each CSV column (Owner.Name included) → its describe() field type.
+
+    Relationship columns are followed through referenceTo with one describe
+    per object; polymorphic lookups and columns describe does not know
+    (aliases, aggregates) are left out and keep their CSV text.
+    """
+    describes = {}
+
+    def describe(name):
+        """(fields by name, lookups by relationship name) for one object, lower-cased."""
+        if name not in describes:
+            fields = sf.restful(f"sobjects/{name}/describe")["fields"]
+            describes[name] = (
+                {field["name"].lower(): field for field in fields},
+                {field["relationshipName"].lower(): field for field in fields if field.get("relationshipName")}
+            )
+        return describes[name]
+
+    types = {}
+
+    for column in columns:
+        current = sobject
+        parts = column.split(".")
+        for part in parts[:-1]:
+            lookup = describe(current)[1].get(part.lower()) or {}
+            targets = lookup.get("referenceTo") or []
+            current = targets[0] if len(targets) == 1 else None
+            if not current:
+                break
+        if not current:
+            continue
+
+        field = describe(current)[0].get(parts[-1].lower())
+        if field:
+            types[column] = field["type"]
+
+    return types
+
+
+def csv_row_to_record(row, column_types=None):
+    """Reshape a Bulk API CSV row like a REST record (nested relationships, nulls, booleans).
+
+    With column_types from bulk_column_types, int/double/currency/percent
+    columns become numbers and only boolean columns become True/False, as in
+    REST; dates stay ISO strings, as REST has them.
+    """
+    column_types = column_types or {}
+    rec = {}
+
+    for column, raw in row.items():
+        parts = column.split(".")
+        target = rec
+        for part in parts[:-1]:
+            target = target.setdefault(part, {})
+
+        value = _csv_value(raw)
+        if isinstance(value, bool) and column_types.get(column, "boolean") != "boolean":
+            value = raw  # a text field that happens to read "true"
+        convert = _NUMBER_TYPES.get(column_types.get(column))
+        if convert and isinstance(value, str):
+            try:
+                value = convert(value)
+            except ValueError:
+                pass
+        target[parts[-1]] = value
+
+    return _collapse_empty(rec)
+
+
+def bulk_query_pages(sf, soql, page_size=50000, poll_interval=5):
+    """Run soql as a Bulk API 2.0 query job and yield the CSV result pages as records."""
+    jobs_url = f"{sf.base_url}jobs/query"
+
+    res = _bulk_request(
+        sf, "POST",
+        jobs_url,
+        headers=_bulk_headers(sf),
+        json={"operation": "query", "query": " ".join(soql.split())}
+    )
+    job_id = res.json()["id"]
+    print(f"DEBUG: Bulk API query job created → {job_id}")
+
+    while True:
+        res = _bulk_request(sf, "GET", f"{jobs_url}/{job_id}", headers=_bulk_headers(sf))
+        job = res.json()
+
+        if job["state"] == "JobComplete":
+            break
+        if job["state"] in ("Failed", "Aborted"):
+            raise Exception(f"❌ Bulk query job {job_id} {job['state']}: {job.get('errorMessage')}")
+
+        time.sleep(poll_interval)
+
+    print(f"DEBUG: Bulk API job complete → {job.get('numberRecordsProcessed')} records")
+
+    sobject = _soql_object(soql)
+    column_types = None
+
+    locator = None
+    while True:
+        params = {"maxRecords": page_size}
+        if locator:
+            params["locator"] = locator
+
+        res = _bulk_request(
+            sf, "GET",
+            f"{jobs_url}/{job_id}/results",
+            headers={"Authorization": f"Bearer {sf.session_id}", "Accept": "text/csv"},
+            params=params
+        )
+        res.encoding = "utf-8"
+
+        reader = csv.DictReader(io.StringIO(res.text))
+        if column_types is None:
+            # Same column set on every page: describe once so types match REST mode
+            column_types = bulk_column_types(sf, sobject, reader.fieldnames or []) if sobject else {}
+
+        yield [csv_row_to_record(row, column_types) for row in reader]
+
+        locator = res.headers.get("Sforce-Locator")
+        if not locator or locator == "null":
+            break
+
+
+def query_pages(sf, soql, mode="rest"):
+    """Yield record pages using the REST cursor or a Bulk API 2.0 job ("bulk")."""
+    if mode == "bulk":
+        return bulk_query_pages(sf, soql)
+    return rest_query_pages(sf, soql)
+
+
+def query_records(sf, soql, mode="rest"):
+    """Yield records one by one from query_pages."""
+    for records in query_pages(sf, soql, mode):
+        yield from records
+
+
+
+def grouped_batches(keyed_records, flush_size=2000, max_buffered=10000):
+    """Group a stream of (key, record) pairs and yield (key, docs) batches.
+
+    A group is flushed once it holds flush_size records, and every group is
+    flushed whenever max_buffered records are waiting overall, so memory stays
+    flat however large the object is and each record is handled in O(1), even
+    with close to one group per record. Partial groups are flushed at the end.
+    """
+    groups = defaultdict(list)
+    buffered = 0
+
+    for key, rec in keyed_records:
+        groups[key].append(rec)
+        buffered += 1
+
+        if len(groups[key]) >= flush_size:
+            docs = groups.pop(key)
+            buffered -= len(docs)
+            yield key, docs
+
+        elif buffered >= max_buffered:
+            yield from groups.items()
+            groups = defaultdict(list)
+            buffered = 0
+
+    yield from groups.items()
+
+# -----------------------------------
+# Fetch / Write Pipeline
+# -----------------------------------
+def prefetch_pages(pages, depth=2):
+    """Pull pages in a background thread, keeping at most depth pages buffered.
+
+    The caller writes one page while the next ones are fetched; the bounded
+    queue blocks the fetcher when writes fall behind.
+    """
+    buffer = queue.Queue(maxsize=max(depth, 1))
+    stop = threading.Event()
+
+    def put(item):
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=1)
+                return True
+            except queue.Full:
+                continue
+        return False
+
+    def producer():
+        # The end marker is always sent, so the consumer never waits on a dead fetcher;
+        # any error, KeyboardInterrupt/SystemExit included, is re-raised by the consumer
+        outcome = _PAGES_DONE
+        try:
+            for page in pages:
+                if not put(page):
+                    return
+        except BaseException as e:
+            outcome = e
+        finally:
+            put(outcome)
+
+    threading.Thread(target=producer, daemon=True).start()
+
+    try:
+        while True:
+            item = buffer.get()
+            if item is _PAGES_DONE:
+                return
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+
+
+# -----------------------------------
+# Windowed Extraction
+# -----------------------------------
+def parse_sf_datetime(value):
+    """Turn a Salesforce datetime string or a stored checkpoint into an aware UTC datetime."""
+    if isinstance(value, str):
+        return datetime.strptime(value, "%Y-%m-%dT%H:%M:%S.%f%z").astimezone(timezone.utc)
+    if isinstance(value, datetime) and value.tzinfo is None:
+        return value.replace(tzinfo=timezone.utc)  # pymongo hands back naive UTC
+    return value
+
+
+def first_modstamp(sf, soql):
+    """Oldest SystemModstamp matching the query's FROM/WHERE, or None for an empty object."""
+    probe = re.sub(r"^\s*SELECT\s.*?\sFROM\s", "SELECT SystemModstamp FROM ", soql.strip(), count=1, flags=re.I | re.S)
+    records = sf.query(f"{probe} ORDER BY SystemModstamp ASC LIMIT 1")["records"]
+    return parse_sf_datetime(records[0]["SystemModstamp"]) if records else None
+
+
+def modstamp_windows(start, end, window_days=30):
+    """Split (start, end] into consecutive (lo, hi] windows of at most window_days.
+
+    Bounds are truncated to whole seconds so they survive the round trip through
+    SOQL literals and Mongo, and line up again on the next run.
+    """
+    step = timedelta(days=window_days)
+    lo = start.replace(microsecond=0)
+    end = end.replace(microsecond=0)
+
+    windows = []
+    while lo < end:
+        hi = min(lo + step, end)
+        windows.append((lo, hi))
+        lo = hi
+    return windows
+
+
+def window_soql(base_query, lo, hi):
+    """SOQL for one (lo, hi] SystemModstamp window, keyset-ordered by (SystemModstamp, Id)."""
+    base_query_clean = base_query.strip()
+    where_keyword = "AND" if "WHERE" in base_query_clean.upper() else "WHERE"
+    return (
+        f"{base_query_clean} {where_keyword} "
+        f"SystemModstamp > {lo.strftime('%Y-%m-%dT%H:%M:%SZ')} AND SystemModstamp <= {hi.strftime('%Y-%m-%dT%H:%M:%SZ')} "
+        f"ORDER BY SystemModstamp ASC, Id ASC"
+    )
+
+
+def completed_windows(checkpoint_coll, source):
+    """Windows of source already marked done in the checkpoint collection."""
+    return {
+        (parse_sf_datetime(doc["window_start"]), parse_sf_datetime(doc["window_end"]))
+        for doc in checkpoint_coll.find(
+            {"window_of": source, "status": "done"}, {"window_start": 1, "window_end": 1}
+        )
+    }
+
+
+def mark_window(checkpoint_coll, source, lo, hi, status, records=0, error=None):
+    """Record one window's outcome next to the object's last_sync_time checkpoint."""
+    checkpoint_coll.update_one(
+        {"window_of": source, "window_start": lo, "window_end": hi},
+        {"$set": {
+            "status": status,
+            "records": records,
+            "error": error,
+            "last_run": datetime.now(timezone.utc)
+        }},
+        upsert=True
+    )
+
+
+def run_windowed_sync(sync_window, source, start, end, checkpoint_coll, update_checkpoint,
+                      window_days=30, max_workers=4):
+    """Run sync_window(lo, hi) for every pending window of (start, end] on a bounded pool.
+
+    Each window is checkpointed on its own. The object checkpoint only advances
+    to the end of the unbroken run of done windows, so a failed window is
+    retried next run while the windows after it are skipped as already done.
+    """
+    windows = modstamp_windows(start, end, window_days)
+    done = completed_windows(checkpoint_coll, source)
+    pending = [window for window in windows if window not in done]
+    print(f"DEBUG: {source} windows → {len(windows)} total, {len(pending)} pending")
+
+    def run(window):
+        lo, hi = window
+        try:
+            count = sync_window(lo, hi)
+        except Exception as e:
+            print(f"❌ Window failed {source} ({lo} → {hi}]: {e}")
+            mark_window(checkpoint_coll, source, lo, hi, "failed", error=str(e))
+            return window, 0, False
+        mark_window(checkpoint_coll, source, lo, hi, "done", count)
+        return window, count, True
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        results = list(executor.map(run, pending))
+
+    done |= {window for window, _, ok in results if ok}
+    safe_until = None
+    for lo, hi in windows:
+        if (lo, hi) not in done:
+            break
+        safe_until = hi
+
+    if safe_until:
+        update_checkpoint(safe_until)
+        checkpoint_coll.delete_many({"window_of": source, "window_end": {"$lte": safe_until}})
+
+    failed = [window for window, _, ok in results if not ok]
+    if failed:
+        raise Exception(f"❌ {len(failed)} of {len(windows)} windows failed for {source}, retried next run")
+
+    return sum(count for _, count, _ in results)
+
+
+# -----------------------------------
+# Multi-Object Scheduler
+# -----------------------------------
+class ApiCallBudget:
+    """Salesforce API calls shared by every sync worker (limit 0 = unlimited)."""
+
+    def __init__(self, limit=0):
+        self.limit = limit
+        self.used = 0
+        self._lock = threading.Lock()
+
+    def spend(self, calls=1):
+        with self._lock:
+            if self.limit and self.used + calls > self.limit:
+                raise Exception(f"❌ Salesforce API call budget exhausted ({self.used}/{self.limit})")
+            self.used += calls
+
+
+class BudgetedSalesforce:
+    """Salesforce wrapper that charges every query/restful call to an ApiCallBudget."""
+
+    CHARGED_METHODS = ("query", "query_more", "query_all", "restful")
+
+    def __init__(self, sf, budget):
+        self._sf = sf
+        self.budget = budget
+
+    def __getattr__(self, name):
+        attr = getattr(self._sf, name)
+        if name not in self.CHARGED_METHODS:
+            return attr
+
+        def charged(*args, **kwargs):
+            self.budget.spend()
+            return attr(*args, **kwargs)
+
+        return charged
+
+
+def count_records(sf, soql):
+    """Estimate an object's backlog by turning its SELECT into SELECT COUNT()."""
+    count_soql = re.sub(r"^\s*SELECT\s.*?\sFROM\s", "SELECT COUNT() FROM ", soql, count=1, flags=re.I | re.S)
+    try:
+        return sf.query(count_soql)["totalSize"]
+    except Exception as e:
+        print(f"⚠️ COUNT() failed, scheduling without size hint: {e}")
+        return 0
+
+
+def run_object_syncs(sync_fn, object_queries, max_workers=3, size_fn=None):
+    """Run sync_fn(obj, query) for every object on a bounded pool and print a summary.
+
+    With size_fn the largest objects are started first (longest-job-first) so
+    the slowest sync does not end up running alone at the tail.
+    """
+    items = list(object_queries.items())
+    sizes = {}
+
+    if size_fn:
+        sizes = {obj: size_fn(obj, query) for obj, query in items}
+        items.sort(key=lambda item: sizes[item[0]], reverse=True)
+        print(f"DEBUG: Sync order (largest first) → {[(obj, sizes[obj]) for obj, _ in items]}")
+
+    def run(obj, query):
+        row = {"object": obj, "estimated": sizes.get(obj), "records": 0, "error": None}
+        started = time.monotonic()
+        try:
+            row["records"] = sync_fn(obj, query) or 0
+        except Exception as e:
+            row["error"] = e
+        row["seconds"] = round(time.monotonic() - started, 1)
+        return row
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        summary = list(executor.map(lambda item: run(*item), items))
+
+    print("\n📊 Sync Summary")
+    for row in summary:
+        status = f"ERROR → {row['error']}" if row["error"] else "OK"
+        print(f"   {row['object']:<28} {row['records']:>9} records {row['seconds']:>9}s  {status}")
+
+    return summary
@@ -0,0 +1,269 @@
+import csv
+import io
+import json
+import threading
+import urllib.error
+import urllib.request
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+from urllib.parse import parse_qs, urlencode, urlsplit
+
+import pytest
+
+from syncHelpers import (
+    ApiCallBudget, BudgetedSalesforce, bulk_column_types, bulk_query_pages, bulk_update_flags, csv_row_to_record
+)
+
+API = "/services/data/v59.0/"
+
+LOAN_DESCRIBE = {
+    "fields": [
+        {"name": "Id", "type": "id"},
+        {"name": "Name", "type": "string"},
+        {"name": "Amount__c", "type": "currency"},
+        {"name": "Rate__c", "type": "percent"},
+        {"name": "Tenure__c", "type": "double"},
+        {"name": "Installments__c", "type": "int"},
+        {"name": "Active__c", "type": "boolean"},
+        {"name": "CreatedDate", "type": "datetime"},
+        {"name": "OwnerId", "type": "reference", "relationshipName": "Owner", "referenceTo": ["User"]},
+        {"name": "WhatId", "type": "reference", "relationshipName": "What", "referenceTo": ["Account", "Case"]}
+    ]
+}
+USER_DESCRIBE = {"fields": [{"name": "Name", "type": "string"}, {"name": "Age__c", "type": "double"}]}
+
+COLUMNS = [
+    "Id", "Name", "Amount__c", "Rate__c", "Tenure__c", "Installments__c",
+    "Active__c", "CreatedDate", "Owner.Name", "Owner.Age__c", "What.Name"
+]
+PAGES = {
+    None: (
+        [
+            ["a01", "true", "1500.5", "7.25", "", "12", "true", "2024-01-02T03:04:05.000+0000", "Asha", "31", "X"],
+            ["a02", "Loan 2", "0", "", "36.0", "", "false", "", "", "", ""]
+        ],
+        "LOC2"
+    ),
+    "LOC2": ([["a03", "Loan 3", "99", "1", "1", "1", "", "", "Ravi", "", ""]], "null")
+}
+
+
+class StubBulkApi(BaseHTTPRequestHandler):
+    """Just enough of the Bulk API 2.0 query/ingest endpoints and sObject describe."""
+
+    def log_message(self, *args):
+        pass
+
+    def _reply(self, status, body, content_type="application/json", headers=None):
+        data = (json.dumps(body) if content_type == "application/json" else body).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", content_type)
+        self.send_header("Content-Length", str(len(data)))
+        for name, value in (headers or {}).items():
+            self.send_header(name, value)
+        self.end_headers()
+        self.wfile.write(data)
+
+    def _body(self):
+        return self.rfile.read(int(self.headers.get("Content-Length") or 0)).decode("utf-8")
+
+    def _record(self):
+        state = self.server.state
+        url = urlsplit(self.path)
+        state["calls"].append((self.command, url.path))
+        assert self.headers["Authorization"] == "Bearer token"
+        return state, url.path[len(API):], parse_qs(url.query)
+
+    def do_POST(self):
+        state, path, _ = self._record()
+        body = json.loads(self._body())
+        if path == "jobs/query":
+            state["query_job"] = body
+            self._reply(200, {"id": "750Q"})
+        elif path == "jobs/ingest":
+            state["ingest_job"] = body
+            self._reply(200, {"id": "750I"})
+        else:
+            self._reply(404, {})
+
+    def do_PUT(self):
+        state, path, _ = self._record()
+        assert path == "jobs/ingest/750I/batches"
+        assert self.headers["Content-Type"] == "text/csv"
+        state["uploaded"] = self._body()
+        self._reply(201, "", "text/plain")
+
+    def do_PATCH(self):
+        state, path, _ = self._record()
+        assert path == "jobs/ingest/750I"
+        state["ingest_state"] = json.loads(self._body())["state"]
+        self._reply(200, {})
+
+    def do_GET(self):
+        state, path, query = self._record()
+
+        if path in ("jobs/query/750Q", "jobs/ingest/750I"):
+            state["polls"][path] = state["polls"].get(path, 0) + 1
+            done = state["polls"][path] > 1
+            self._reply(200, {
+                "id": path.rsplit("/", 1)[1],
+                "state": "JobComplete" if done else "InProgress",
+                "numberRecordsProcessed": 3,
+                "numberRecordsFailed": 1
+            })
+        elif path == "jobs/query/750Q/results":
+            assert query["maxRecords"] == ["2"]
+            state["locators"].append(query.get("locator", [None])[0])
+            rows, locator = PAGES[state["locators"][-1]]
+            out = io.StringIO()
+            writer = csv.writer(out, lineterminator="\n")
+            writer.writerow(COLUMNS)
+            writer.writerows(rows)
+            self._reply(200, out.getvalue(), "text/csv", {"Sforce-Locator": locator})
+        elif path == "jobs/ingest/750I/failedResults":
+            self._reply(200, "sf__Id,sf__Error,Id,Migrated_to_Mongo__c\n001B,ENTITY_IS_DELETED:deleted,001B,true\n", "text/csv")
+        elif path == "sobjects/Loan__c/describe":
+            self._reply(200, LOAN_DESCRIBE)
+        elif path == "sobjects/User/describe":
+            self._reply(200, USER_DESCRIBE)
+        else:
+            self._reply(404, {})
+
+
+class StubResponse:
+    def __init__(self, status_code, content, headers):
+        self.status_code = status_code
+        self.content = content
+        self.headers = headers
+        self.encoding = "utf-8"
+
+    @property
+    def text(self):
+        return self.content.decode(self.encoding)
+
+    def json(self):
+        return json.loads(self.content)
+
+    def raise_for_status(self):
+        if self.status_code >= 400:
+            raise Exception(f"HTTP {self.status_code}")
+
+
+_dumps = json.dumps  # UrllibSession.request takes a json= argument, like requests
+
+
+class UrllibSession:
+    """The slice of requests.Session that syncHelpers uses, over urllib."""
+
+    def request(self, method, url, headers=None, json=None, data=None, params=None):
+        if params:
+            url += "?" + urlencode(params)
+        if json is not None:
+            data = _dumps(json).encode("utf-8")
+        req = urllib.request.Request(url, data=data, method=method, headers=headers or {})
+        try:
+            res = urllib.request.urlopen(req, timeout=10)
+        except urllib.error.HTTPError as e:
+            res = e
+        with res:
+            return StubResponse(res.status, res.read(), res.headers)
+
+
+class StubSalesforce:
+    def __init__(self, base_url):
+        self.base_url = base_url
+        self.session_id = "token"
+        self.session = UrllibSession()
+
+    def restful(self, path):
+        res = self.session.request("GET", self.base_url + path, headers={"Authorization": "Bearer token"})
+        res.raise_for_status()
+        return res.json()
+
+
+@pytest.fixture
+def stub():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubBulkApi)
+    server.state = {"calls": [], "polls": {}, "locators": []}
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    try:
+        yield server.state, StubSalesforce(f"http://127.0.0.1:{server.server_port}{API}")
+    finally:
+        server.shutdown()
+        server.server_close()
+
+
+def test_bulk_query_pages_polls_and_follows_locator(stub):
+    state, sf = stub
+
+    pages = list(bulk_query_pages(sf, "SELECT Id, Name\n  FROM Loan__c", page_size=2, poll_interval=0))
+
+    assert state["query_job"] == {"operation": "query", "query": "SELECT Id, Name FROM Loan__c"}
+    assert state["polls"]["jobs/query/750Q"] == 2
+    assert state["locators"] == [None, "LOC2"]
+    assert [len(page) for page in pages] == [2, 1]
+    assert [rec["Id"] for page in pages for rec in page] == ["a01", "a02", "a03"]
+
+
+def test_bulk_query_pages_coerces_types_like_rest(stub):
+    _, sf = stub
+
+    first, second = list(bulk_query_pages(sf, "SELECT Id FROM Loan__c", page_size=2, poll_interval=0))
+    a01, a02 = first
+
+    assert a01["Name"] == "true"
+    assert a01["Amount__c"] == 1500.5 and isinstance(a01["Amount__c"], float)
+    assert a01["Rate__c"] == 7.25
+    assert a01["Tenure__c"] is None
+    assert a01["Installments__c"] == 12 and isinstance(a01["Installments__c"], int)
+    assert a01["Active__c"] is True
+    assert a01["CreatedDate"] == "2024-01-02T03:04:05.000+0000"
+    assert a01["Owner"] == {"Name": "Asha", "Age__c": 31.0}
+    assert a01["What"] == {"Name": "X"}
+
+    assert a02["Amount__c"] == 0.0 and isinstance(a02["Amount__c"], float)
+    assert a02["Tenure__c"] == 36.0
+    assert a02["Active__c"] is False
+    assert a02["Owner"] is None
+    assert second[0]["Active__c"] is None
+
+
+def test_bulk_update_flags_uploads_csv_and_returns_failures(stub):
+    state, sf = stub
+
+    failures = bulk_update_flags(sf, "Loan__c", ["001A", "001B"], poll_interval=0)
+
+    assert state["ingest_job"] == {"object": "Loan__c", "operation": "update", "contentType": "CSV", "lineEnding": "LF"}
+    assert state["uploaded"] == "Id,Migrated_to_Mongo__c\n001A,true\n001B,true\n"
+    assert state["ingest_state"] == "UploadComplete"
+    assert state["polls"]["jobs/ingest/750I"] == 2
+    assert failures == {"001B": "ENTITY_IS_DELETED:deleted"}
+
+
+def test_bulk_calls_are_charged_to_the_budget(stub):
+    state, sf = stub
+    budget = ApiCallBudget()
+
+    list(bulk_query_pages(BudgetedSalesforce(sf, budget), "SELECT Id FROM Loan__c", page_size=2, poll_interval=0))
+
+    assert budget.used == len(state["calls"])
+
+
+def test_bulk_column_types_follow_single_lookups_only(stub):
+    _, sf = stub
+
+    types = bulk_column_types(sf, "Loan__c", ["Amount__c", "Owner.Age__c", "What.Name", "expr0"])
+
+    assert types == {"Amount__c": "currency", "Owner.Age__c": "double"}
+
+
+def test_csv_row_to_record_without_types_keeps_text():
+    rec = csv_row_to_record({"Id": "a01", "Amount__c": "1.5", "Active__c": "true", "Owner.Name": ""})
+
+    assert rec == {"Id": "a01", "Amount__c": "1.5", "Active__c": True, "Owner": None}
+
+
+def test_csv_row_to_record_leaves_unparseable_numbers():
+    rec = csv_row_to_record({"Amount__c": "n/a"}, {"Amount__c": "currency"})
+
+    assert rec == {"Amount__c": "n/a"}
@@ -1,10 +1,9 @@
 import os
-import requests
-import base64
 from datetime import datetime
 from dotenv import load_dotenv
 from pymongo import MongoClient
 from simple_salesforce import Salesforce
+from dmsHelpers import spool_version_data, upload_multipart, upload_base64_json, resolve_linked_documents, load_done_ids, HttpTransport
 
 # ---------------------------------------------------
 # LOAD ENV
@@ -22,6 +21,11 @@ DMS_AUTH = os.getenv("DMS_AUTH_HEADER").replace('"', '')
 
 SIX_MB = 6 * 1024 * 1024  # 6MB in bytes
 
+DMS_UPLOAD_MODE = os.getenv("DMS_UPLOAD_MODE", "multipart")  # multipart | json (legacy base64 body)
+DOWNLOAD_CHUNK_SIZE = int(os.getenv("DMS_DOWNLOAD_CHUNK_SIZE", 1024 * 1024))  # bytes per read while streaming
+SPOOL_MAX_MEMORY = int(os.getenv("DMS_SPOOL_MAX_MEMORY", 16 * 1024 * 1024))  # above this a file spills to a temp file
+transport = HttpTransport()  # one keep-alive session per host, reused for every file
+
 print("MONGO_URI USED:", MONGO_URI)
 
 # ---------------------------------------------------
@@ -90,8 +94,8 @@ def fetch_files(vertical, object_name, start_date, end_date):
     print("\n🔎 Fetching ContentVersion records (Date + Size Filter)...")
 
     version_query = f"""
-        SELECT Id, Title, FileType, ContentDocumentId,
-               CreatedDate, VersionData, ContentSize
+        SELECT Id, Title, FileType, FileExtension, ContentDocumentId,
+               CreatedDate, CreatedBy.Name, ContentSize
         FROM ContentVersion
         WHERE IsLatest = true
         AND CreatedDate >= {start_date}T00:00:00Z
@@ -107,82 +111,107 @@ def fetch_files(vertical, object_name, start_date, end_date):
     if not all_versions:
         return []
 
-    filtered_files = []
-
     print("\n🔎 Filtering by Object + Vertical...")
 
-    for file in all_versions:
-
-        doc_id = file["ContentDocumentId"]
-
-        link_query = f"""
-            SELECT LinkedEntityId
-            FROM ContentDocumentLink
-            WHERE ContentDocumentId = '{doc_id}'
-        """
-
-        links = sf.query_all(link_query)
-
-        for link in links['records']:
-
-            parent_id = link["LinkedEntityId"]
-
-            parent_query = f"""
-                SELECT Id
-                FROM {object_name}
-                WHERE Id = '{parent_id}'
-                AND Vertical__c = '{vertical}'
-                LIMIT 1
-            """
-
-            parent_check = sf.query(parent_query)
+    # One ContentDocumentLink semi-join per chunk of ContentDocumentIds
+    linked = resolve_linked_documents(
+        sf,
+        {file["ContentDocumentId"] for file in all_versions},
+        f"SELECT Id FROM {object_name} WHERE Vertical__c = '{vertical}'"
+    )
 
-            if parent_check['records']:
-                filtered_files.append(file)
-                break
+    filtered_files = [file for file in all_versions if file["ContentDocumentId"] in linked]
 
     print(f"Final Files After Vertical Filter: {len(filtered_files)}")
 
     return filtered_files
 
 
+# ---------------------------------------------------
+# DMS PAYLOAD
+# ---------------------------------------------------
+def build_dms_payload(file_record, size, checksum, vertical, filename):
+
+    created_date = datetime.strptime(
+        file_record["CreatedDate"][:10], "%Y-%m-%d"
+    ).strftime("%d/%m/%Y")
+
+    created_by = (file_record.get("CreatedBy") or {}).get("Name")
+
+    return {
+        "imageId": file_record["ContentDocumentId"],
+        "uniqueId": file_record["Id"],
+        "sourceSys": "Gallop",
+        "branchCode": "1208",
+        "branch": "HO",
+        "vertical": vertical or "Unknown",
+        "stage": "FI",
+        "module": "Notice Letters",
+        "imageCategory": "0",
+        "imageSubCategory": "0",
+        "status": "1",
+        "fileName": filename,
+        "format": (file_record.get("FileExtension") or "").lower(),
+        "user": created_by,
+        "size": str(size),
+        "createdBy": created_by,
+        "createdDate": created_date,
+        "checkSum": checksum,
+        "keyId": ["agreementNo"],
+        "keyValue": ["UNKNOWN"]
+    }
+
+
 # ---------------------------------------------------
 # PUSH TO DMS
 # ---------------------------------------------------
-def push_to_dms(file_record):
+def push_to_dms(file_record, vertical):
 
     file_id = file_record["Id"]
     title = file_record["Title"]
     file_type = file_record["FileType"]
-    version_data_url = file_record["VersionData"]
+    ext = file_record.get("FileExtension")
 
-    if file_tracking.find_one({"salesforce_file_id": file_id}):
-        print(f"⏭ Skipping (Already Migrated): {title}")
-        return
+    filename = title
+    if ext and not title.lower().endswith(f".{ext.lower()}"):
+        filename = f"{title}.{ext}"
 
     try:
-        file_binary = sf._call_salesforce("GET", version_data_url)
-        encoded_file = base64.b64encode(file_binary).decode()
-
-        payload = {
-            "fileName": title,
-            "fileType": file_type,
-            "fileData": encoded_file
-        }
+        # VersionData is streamed into a bounded spool instead of one in-memory blob
+        spool, size, checksum = spool_version_data(
+            sf, file_id, SPOOL_MAX_MEMORY, DOWNLOAD_CHUNK_SIZE, timeout=120, session=transport
+        )
 
         headers = {
-            "Authorization": DMS_AUTH,
-            "Content-Type": "application/json"
+            "Authorization": DMS_AUTH
         }
 
-        response = requests.post(
-            DMS_ENDPOINT,
-            json=payload,
-            headers=headers,
-            timeout=120
-        )
-
-        if response.status_code == 200:
+        with spool:
+            if DMS_UPLOAD_MODE == "json":
+                # Legacy JSON contract: base64 is produced chunk by chunk as the body is sent
+                response = upload_base64_json(
+                    DMS_ENDPOINT,
+                    headers,
+                    {"fileName": title, "fileType": file_type},
+                    "fileData",
+                    spool,
+                    size,
+                    timeout=120,
+                    session=transport
+                )
+            else:
+                response = upload_multipart(
+                    DMS_ENDPOINT,
+                    headers,
+                    build_dms_payload(file_record, size, checksum, vertical, filename),
+                    filename,
+                    spool,
+                    size,
+                    timeout=120,
+                    session=transport
+                )
+
+        if response.status_code in [200, 201]:
             print(f"✅ Uploaded: {title}")
 
             file_tracking.insert_one({
@@ -237,9 +266,14 @@ if __name__ == "__main__":
         print("\n⚠ No files to migrate.")
         exit()
 
+    # Files already in file_tracking are dropped up front with one $in query
+    done = load_done_ids(file_tracking, (f["Id"] for f in files), id_field="salesforce_file_id")
+    files = [f for f in files if f["Id"] not in done]
+
     print("\n🚀 Starting Migration...\n")
 
     for file in files:
-        push_to_dms(file)
+        push_to_dms(file, vertical_input)
 
+    print("🌐 HTTP pools:", transport.stats())
     print("\n🎯 Migration Completed Successfully")